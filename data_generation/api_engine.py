@@ -0,0 +1,275 @@
+import time
+import random
+import asyncio
+import email.utils
+
+import httpx
+import openai
+
+########################################################
+# rate limiting
+########################################################
+
+# HTTP status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit on the number of in-flight requests. The limit grows by about one
+    slot per window of successful requests, halves when the server rate limits
+    us (429), and shrinks gently when the time per token stays well above its
+    running average for several requests in a row (the server is saturated).
+    Latency is normalized by the request's work, generated tokens plus prompt
+    tokens weighted by `prefill_cost`, so requests of different sizes compare.
+    Slow requests move the average only slightly, so a saturated server keeps
+    looking slow until the limit comes down.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=256, latency_tolerance=2.0, decrease_cooldown=1.0,
+                 prefill_cost=0.1, baseline_smoothing=0.02, slow_smoothing=0.001, slow_requests=5):
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.decrease_cooldown = decrease_cooldown
+        self.prefill_cost = prefill_cost
+        self.baseline_smoothing = baseline_smoothing
+        self.slow_smoothing = slow_smoothing
+        self.slow_requests = slow_requests
+        self.in_flight = 0
+        self.baseline_latency = None
+        self.num_slow = 0
+        self.last_decrease = 0.0
+        self.condition = None
+
+    async def acquire(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _decrease(self, factor):
+        # one decrease per cooldown: a burst of failures reflects a single overload
+        now = time.monotonic()
+        if now - self.last_decrease >= self.decrease_cooldown:
+            self.limit = max(self.minimum, self.limit * factor)
+            self.last_decrease = now
+
+    def on_success(self, latency, prompt_tokens, completion_tokens):
+        """Record a successful request that took `latency` seconds."""
+        latency /= max(1.0, completion_tokens + self.prefill_cost * prompt_tokens)
+        if self.baseline_latency is None:
+            self.baseline_latency = latency
+        slow = latency > self.latency_tolerance * self.baseline_latency
+        # EWMA over recent requests, so it follows changes in the mix of request sizes
+        smoothing = self.slow_smoothing if slow else self.baseline_smoothing
+        self.baseline_latency += smoothing * (latency - self.baseline_latency)
+        self.num_slow = self.num_slow + 1 if slow else 0
+        if self.num_slow >= self.slow_requests:
+            self._decrease(0.9)
+            self.num_slow = 0
+        elif not slow:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_rate_limited(self):
+        self._decrease(0.5)
+
+class TokenBucket:
+    """Token bucket for a per-minute quota (tokens or requests); `None` means unlimited."""
+
+    def __init__(self, per_minute=None):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    async def acquire(self, amount):
+        if self.capacity is None:
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) * 60.0 / self.capacity)
+                self._refill()
+            self.tokens -= amount
+
+    def refund(self, amount):
+        """Give back (or, if negative, take) tokens once the actual usage is known."""
+        if self.capacity is None:
+            return
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+def parse_retry_after(headers):
+    """Seconds to wait according to `retry-after-ms` / `retry-after` headers, or None."""
+    if headers is None:
+        return None
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000.0
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+        return max(0.0, retry_date.timestamp() - time.time()) if retry_date else None
+
+def estimate_tokens(text):
+    # rough count for quota accounting before the server reports usage
+    return len(text) // 4 + 1
+
+########################################################
+# engine
+########################################################
+
+class APIGenerationEngine:
+    """
+    Asyncio engine for OpenAI-compatible chat completion APIs (Azure OpenAI,
+    vLLM). All requests share one client and its HTTP connection pool; the
+    number of in-flight requests adapts to latency and 429 responses, requests
+    are retried with exponential backoff and full jitter (honoring Retry-After),
+    and optional token / request per-minute quotas are enforced client-side.
+    """
+
+    def __init__(self,
+                 client,
+                 make_request,
+                 parse_choice=None,
+                 initial_concurrency=16,
+                 min_concurrency=1,
+                 max_concurrency=128,
+                 max_retries=5,
+                 backoff_base=1.0,
+                 backoff_max=60.0,
+                 tokens_per_minute=None,
+                 requests_per_minute=None):
+        self.client = client
+        self.make_request = make_request
+        self.parse_choice = parse_choice or (lambda choice: choice.message.content)
+        self.concurrency = AdaptiveConcurrencyLimiter(initial_concurrency, min_concurrency, max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.request_bucket = TokenBucket(requests_per_minute)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def generate(self, example, stats=None):
+        """
+        Generate the completions of one example, one row per requested sample
+        (`n`); errors end up in `output_synthetic`. If given, `stats` (holding
+        the `queued_at` time) is filled with the request's queue time, latency,
+        token usage and retry count.
+        """
+        stats = {} if stats is None else stats
+        stats.update(ttft=None, prompt_tokens=None, completion_tokens=None, retries=0)
+        queued_at = stats.pop("queued_at", time.monotonic())
+        request = self.make_request(example)
+        num_samples = request.get("n", 1)
+        estimated_tokens = estimate_tokens(example["input"]) + request.get("max_tokens", 0) * num_samples
+
+        for attempt in range(self.max_retries + 1):
+            await self.token_bucket.acquire(estimated_tokens)
+            await self.request_bucket.acquire(1)
+            await self.concurrency.acquire()
+            start = time.monotonic()
+            if attempt == 0:
+                stats["queue_time"] = start - queued_at
+            stats["retries"] = attempt
+            try:
+                response = await self.client.chat.completions.create(**request)
+            except Exception as e:
+                status_code = getattr(e, "status_code", None)
+                if status_code == 429:
+                    self.concurrency.on_rate_limited()
+                retryable = status_code in RETRYABLE_STATUS_CODES or isinstance(e, openai.APIConnectionError)
+                if not retryable or attempt == self.max_retries:
+                    stats["latency"] = time.monotonic() - queued_at - stats["queue_time"]
+                    print(f"Error processing example: {e}")
+                    return [{
+                        "input": example["input"],
+                        "output_synthetic": f"ERRORED ({e})",
+                        "output_gt": example["output"],
+                        "sample_index": sample_index,
+                        "completion_tokens": None,
+                    } for sample_index in range(num_samples)]
+                response = getattr(e, "response", None)
+                delay = parse_retry_after(response.headers if response is not None else None)
+                if delay is None:
+                    delay = self._backoff(attempt)
+            else:
+                latency = time.monotonic() - start
+                usage = getattr(response, "usage", None)
+                self.concurrency.on_success(
+                    latency,
+                    getattr(usage, "prompt_tokens", None) or estimate_tokens(example["input"]),
+                    getattr(usage, "completion_tokens", None) or 1,
+                )
+                if usage is not None:
+                    self.token_bucket.refund(estimated_tokens - usage.total_tokens)
+                    stats.update(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+                stats["latency"] = time.monotonic() - queued_at - stats["queue_time"]
+                return [{
+                    "input": example["input"],
+                    "output_synthetic": self.parse_choice(choice),
+                    "output_gt": example["output"],
+                    "sample_index": choice.index,
+                    # usage is per request: only attributable to a row when there is one sample
+                    "completion_tokens": usage.completion_tokens if usage is not None and num_samples == 1 else None,
+                } for choice in sorted(response.choices, key=lambda choice: choice.index)]
+            finally:
+                await self.concurrency.release()
+            await asyncio.sleep(delay)
+
+    async def run(self, examples, on_result):
+        """
+        Generate all (index, example) pairs, calling `on_result(index, results, stats)`
+        as each one finishes (in completion order).
+        """
+        queue = asyncio.Queue()
+        for item in examples:
+            queue.put_nowait(item)
+        queued_at = time.monotonic()
+
+        async def worker():
+            while True:
+                try:
+                    idx, example = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                stats = {"queued_at": queued_at}
+                results = await self.generate(example, stats)
+                on_result(idx, results, stats)
+
+        try:
+            await asyncio.gather(*(worker() for _ in range(min(self.max_concurrency, max(1, queue.qsize())))))
+        finally:
+            await self.client.close()
+
+def make_http_client(max_connections):
+    """HTTP client with a connection pool sized for the engine's maximum concurrency."""
+    return openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+    )
@@ -0,0 +1,34 @@
+import json
+import argparse
+
+from utils import *
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--config", type=str)
+parser.add_argument("--tokenizer", type=str, default=None, help="measure reuse in tokens instead of characters")
+parser.add_argument("--cache_sizes", type=int, nargs="+", default=[1, 16, 64, 256], help="number of prompts the prefix cache holds")
+args = parser.parse_args()
+
+with open(args.config, "r") as f:
+    config_data = json.load(f)
+
+# the same prompts generate.py sends, including context packing
+prompts = prepare_dataset(argparse.Namespace(**config_data))["input"]
+unit = "characters"
+if args.tokenizer is not None:
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, trust_remote_code=True)
+    prompts = [tuple(input_ids) for input_ids in tokenizer(prompts)["input_ids"]]
+    unit = "tokens"
+
+orders = {
+    "file": list(range(len(prompts))),
+    "prefix": order_by_shared_prefix(prompts),
+}
+
+print(f"{len(prompts)} prompts, {sum(len(prompt) for prompt in prompts)} {unit}")
+print("prefix-reuse ratio (fraction of prompt " + unit + " served from cache):")
+print(f"{'cache size':>12}" + "".join(f"{name:>10}" for name in orders))
+for cache_size in args.cache_sizes:
+    ratios = [prefix_reuse_ratio(prompts, order, cache_size) for order in orders.values()]
+    print(f"{cache_size:>12}" + "".join(f"{ratio:>10.3f}" for ratio in ratios))
@@ -1,21 +1,24 @@
-import time
 import os
+import copy
 import json
+import time
+import asyncio
 import argparse
+import importlib.util
 from tqdm import tqdm
-import concurrent.futures
 
-from litellm import completion
-from openai import AzureOpenAI  
+from openai import AsyncAzureOpenAI, AsyncOpenAI
 
 import torch
 from datasets import load_dataset
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, StopStringCriteria
+from transformers.generation import LogitsProcessorList
 
 from dotenv import load_dotenv
 load_dotenv()
 
 from utils import *
+from api_engine import APIGenerationEngine, make_http_client
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--config", type=str)
@@ -35,37 +38,46 @@ script_args = ScriptArguments(config_data)
 # dataset
 ########################################################
 
-def prepare_dataset(script_args: ScriptArguments):
-    dataset = load_dataset("json", data_files=[script_args.input_data_path], split="train")
-    if script_args.experiment_name == "exp1_without_context":
-        dataset = dataset.map(lambda x: process_input_exp1_without_context(x, script_args.prompt_template), load_from_cache_file=False)
-        dataset = dataset.map(process_output_exp1_without_context, load_from_cache_file=False)
-    elif script_args.experiment_name == "exp1_with_context":
-        dataset = dataset.map(lambda x: process_input_exp1_with_context(x, script_args.prompt_template), load_from_cache_file=False)
-        dataset = dataset.map(process_output_exp1_with_context, load_from_cache_file=False)
-    elif script_args.experiment_name == "exp2_without_context":
-        dataset = dataset.map(lambda x: process_input_exp2_without_context(x, script_args.prompt_template), load_from_cache_file=False)
-        dataset = dataset.map(process_output_exp2_without_context, load_from_cache_file=False)
-    elif script_args.experiment_name == "exp2_with_context":
-        dataset = dataset.map(lambda x: process_input_exp2_with_context(x, script_args.prompt_template), load_from_cache_file=False)
-        dataset = dataset.map(process_output_exp2_with_context, load_from_cache_file=False)
-    else:
-        raise ValueError(f"Experiment name {script_args.experiment_name} not supported")
-    dataset = dataset.remove_columns(["INPUT", "OUTPUT"])
-    return dataset
-
 dataset = prepare_dataset(script_args)
 print(dataset)
 
+# each example gets `num_samples` consecutive output rows (one per sample)
+num_samples = getattr(script_args, "num_samples", 1)
+writer = ResultWriter(script_args.output_data_path, len(dataset) * num_samples)
+todo_indices = sorted({slot // num_samples for slot in writer.remaining()})
+print(f"Generating {len(todo_indices)} / {len(dataset)} examples ({len(dataset) - len(todo_indices)} already done)")
+
+# "prefix" sends rows sharing a prompt prefix back to back so prefix caches get hits;
+# results are still written in dataset order
+schedule = getattr(script_args, "schedule", "file")
+if schedule == "prefix":
+    todo_indices = order_by_shared_prefix(dataset["input"], todo_indices)
+elif schedule != "file":
+    raise ValueError(f"Schedule {schedule} not supported")
+
+def write_samples(idx, results):
+    for sample_index, result in enumerate(results):
+        writer.write(idx * num_samples + sample_index, result)
+
 ########################################################
 # model
 ########################################################
 
+# generation ends at the template's closing tag (a `<SUBMIT>` marker comes before it)
+stop_sequences = getattr(script_args, "stop_sequences", ["</code>"])
+
+# the offline vLLM engine needs a GPU (and vllm); otherwise run the same config on the local backend
+if script_args.model_type == "vllm_offline" and not (torch.cuda.is_available() and importlib.util.find_spec("vllm")):
+    print("vLLM offline engine unavailable (requires vllm and a GPU), falling back to the local backend")
+    script_args.model_type = "local"
+
 if script_args.model_type == "local":
     tokenizer = AutoTokenizer.from_pretrained(
         script_args.model_id,
         trust_remote_code=True,
         padding_side="left",
+        # a prompt still over max_seq_length loses its oldest context, not the instructions at the end
+        truncation_side="left",
     )
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
@@ -82,128 +94,321 @@ if script_args.model_type == "local":
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model.to(device)
 
-    sampling_params = {
-        "do_sample": script_args.do_sample,
-        "temperature": script_args.temperature,
-        "top_p": script_args.top_p,
-        "top_k": script_args.top_k,
-        "min_p": script_args.min_p,
-        "max_new_tokens": script_args.max_new_tokens,
-        "pad_token_id": tokenizer.eos_token_id,
-    }
-
-    results = []
-    for start_idx in tqdm(range(0, len(dataset), script_args.batch_size)):
-        batch = dataset[start_idx:(start_idx+script_args.batch_size)]
-        input_texts = batch["input"]
-        output_texts_gt = batch["output"]
-        inputs = tokenizer(
-            input_texts,
-            return_tensors="pt",
-            truncation=True,
+    # the model's generation config with the script's sampling args (and any extra
+    # `generation_config` entries, e.g. repetition_penalty) on top, as model.generate would use it
+    generation_config = copy.deepcopy(model.generation_config)
+    generation_config.update(
+        do_sample=script_args.do_sample,
+        temperature=script_args.temperature,
+        top_p=script_args.top_p,
+        top_k=script_args.top_k,
+        min_p=script_args.min_p,
+        max_new_tokens=script_args.max_new_tokens,
+        pad_token_id=tokenizer.eos_token_id,
+        **getattr(script_args, "generation_config", {}),
+    )
+    generation_config.validate()
+    # the decode loop below drops finished rows, which these processors can't follow
+    if generation_config.guidance_scale not in (None, 1) or generation_config.watermarking_config is not None:
+        raise ValueError("guidance_scale and watermarking_config are not supported by the local backend")
+    model._prepare_special_tokens(generation_config, kwargs_has_attention_mask=True, device=device)
+    eos_token_ids = generation_config._eos_token_tensor
+    if eos_token_ids is None:
+        eos_token_ids = torch.tensor(tokenizer.eos_token_id, device=device)
+    eos_token_ids = eos_token_ids.flatten()
+    stopping_criteria = StopStringCriteria(tokenizer, stop_sequences) if stop_sequences else None
+
+    def generate_samples(model, inputs, num_samples):
+        """
+        Sample `num_samples` sequences per prompt and return the new token ids
+        of each sequence (grouped by prompt), without the prompt or padding,
+        along with the time the first tokens were sampled and the time each
+        sequence finished.
+        The prompts are prefilled once and their KV cache is repeated for each
+        sample. A sequence stops at EOS or a stop sequence and is then dropped
+        from the batch (and the KV cache), so finished sequences cost nothing
+        while the rest of the batch keeps decoding.
+        """
+        input_ids, attention_mask = inputs["input_ids"], inputs["attention_mask"]
+        prompt_length = input_ids.shape[1]
+        # the same processors (penalties, min length, warpers, ...) model.generate builds
+        logits_processor = model._get_logits_processor(
+            generation_config=generation_config,
+            input_ids_seq_length=prompt_length,
+            encoder_input_ids=input_ids,
+            prefix_allowed_tokens_fn=None,
+            logits_processor=LogitsProcessorList(),
+            device=device,
+        )
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        outputs = model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+            logits_to_keep=1,
+        )
+        past_key_values = outputs.past_key_values
+        logits = outputs.logits[:, -1, :].float()
+        if num_samples > 1:
+            past_key_values.batch_repeat_interleave(num_samples)
+            logits = logits.repeat_interleave(num_samples, dim=0)
+            attention_mask = attention_mask.repeat_interleave(num_samples, dim=0)
+            input_ids = input_ids.repeat_interleave(num_samples, dim=0)
+
+        # processors and stop strings see the prompt and the tokens sampled so far
+        num_sequences = logits.shape[0]
+        active = torch.arange(num_sequences, device=device)
+        active_ids = input_ids
+        completions = [None] * num_sequences
+        finish_times = [None] * num_sequences
+        for step in range(script_args.max_new_tokens):
+            scores = logits_processor(active_ids, logits)
+            if script_args.do_sample:
+                next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+            else:
+                next_tokens = scores.argmax(dim=-1)
+            active_ids = torch.cat([active_ids, next_tokens[:, None]], dim=1)
+            if step == 0:
+                first_token_time = time.monotonic()
+
+            finished = torch.isin(next_tokens, eos_token_ids)
+            if stopping_criteria is not None:
+                finished |= stopping_criteria(active_ids, scores)
+            if step + 1 == script_args.max_new_tokens:
+                finished[:] = True
+            if finished.any():
+                finish_time = time.monotonic()
+                for row in finished.nonzero().flatten().tolist():
+                    completions[active[row]] = active_ids[row, prompt_length:]
+                    finish_times[active[row]] = finish_time
+                keep = (~finished).nonzero().flatten()
+                if len(keep) == 0:
+                    break
+                active, active_ids, next_tokens, attention_mask = \
+                    active[keep], active_ids[keep], next_tokens[keep], attention_mask[keep]
+                past_key_values.batch_select_indices(keep)
+
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(active), 1))], dim=1)
+            logits = model(
+                input_ids=next_tokens[:, None],
+                attention_mask=attention_mask,
+                position_ids=attention_mask.sum(-1, keepdim=True) - 1,
+                past_key_values=past_key_values,
+                use_cache=True,
+            ).logits[:, -1, :].float()
+        return completions, first_token_time, finish_times
+
+    # tokenize once, then batch prompts of similar length under a token budget
+    input_texts = dataset["input"]
+    output_texts_gt = dataset["output"]
+    encodings = tokenizer(
+        [input_texts[idx] for idx in todo_indices],
+        truncation=True,
+        max_length=script_args.max_seq_length,
+    )
+    max_batch_tokens = getattr(script_args, "max_batch_tokens", None) or \
+        script_args.batch_size * (script_args.max_seq_length + script_args.max_new_tokens)
+    # every prompt decodes `num_samples` sequences, which all hold a copy of the prompt's KV cache
+    batches = build_token_budget_batches(
+        [len(input_ids) * num_samples for input_ids in encodings["input_ids"]],
+        max_batch_tokens=max_batch_tokens,
+        extra_tokens=script_args.max_new_tokens * num_samples,
+        max_batch_size=getattr(script_args, "max_batch_size", None),
+    )
+
+    metrics = GenerationMetrics(script_args.model_type)
+    for batch_positions in tqdm(batches):
+        batch_start = time.monotonic()
+        inputs = tokenizer.pad(
+            {
+                "input_ids": [encodings["input_ids"][pos] for pos in batch_positions],
+                "attention_mask": [encodings["attention_mask"][pos] for pos in batch_positions],
+            },
             padding=True,
-            max_length=script_args.max_seq_length,
+            return_tensors="pt",
         ).to(device)
         
         with torch.no_grad():
-            output_ids = model.generate(
-                **inputs,
-                **sampling_params,
+            completion_ids, first_token_time, finish_times = generate_samples(model, inputs, num_samples)
+        # decode only the new tokens; the prompt never goes through the detokenizer
+        completion_ids = [ids.tolist() for ids in completion_ids]
+        decoded_outputs = tokenizer.batch_decode(completion_ids, skip_special_tokens=True)
+        for i, pos in enumerate(batch_positions):
+            idx = todo_indices[pos]
+            results = []
+            for sample_index in range(num_samples):
+                results.append({
+                    "input": input_texts[idx],
+                    "output_synthetic": decoded_outputs[i * num_samples + sample_index],
+                    "output_gt": output_texts_gt[idx],
+                    "sample_index": sample_index,
+                    "completion_tokens": len(completion_ids[i * num_samples + sample_index]),
+                })
+            write_samples(idx, results)
+            metrics.record(
+                idx,
+                queue_time=batch_start - metrics.start,
+                ttft=first_token_time - batch_start,
+                latency=max(finish_times[i * num_samples:(i + 1) * num_samples]) - batch_start,
+                prompt_tokens=len(encodings["input_ids"][pos]),
+                completion_tokens=sum(result["completion_tokens"] for result in results),
             )
-        decoded_outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)
-        for idx, full_text in enumerate(decoded_outputs):
-            input_text = input_texts[idx]
-            output_text = full_text[len(input_text):]
-            result = {
-                "input": input_text,
-                "output_synthetic": output_text,
-                "output_gt": output_texts_gt[idx],
-            }
-            results.append(result)
-            with open(script_args.output_data_path, "a") as f:
-                f.write(json.dumps(result, ensure_ascii=False) + "\n")
                 
-elif script_args.model_type == "azure_openai":
-    results = []
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_API_BASE"),
-        api_key=os.getenv("AZURE_API_KEY"),
-        api_version=os.getenv("AZURE_API_VERSION"),
+elif script_args.model_type == "vllm_offline":
+    from vllm import LLM, SamplingParams
+
+    llm = LLM(
+        model=script_args.model_id,
+        dtype="bfloat16",
+        trust_remote_code=True,
+        max_model_len=script_args.max_seq_length + script_args.max_new_tokens,
+        tensor_parallel_size=getattr(script_args, "tensor_parallel_size", 1),
+        gpu_memory_utilization=getattr(script_args, "gpu_memory_utilization", 0.9),
+        enable_prefix_caching=True,
     )
-    def process_example_azure(example, max_retries=5):
-        input_text = example["input"]
-        output_text_gt = example["output"]
-        num_retries = 0
-        while True:
-            try:
-                response = client.chat.completions.create(
-                    model=script_args.model_id,
-                    messages=[
-                        {"role": "system", "content": [{"type": "text", "text": script_args.system_prompt}]},
-                        {"role": "user", "content": [{"type": "text", "text": input_text}]}
-                    ],
-                    max_tokens=script_args.max_new_tokens,
-                    temperature=script_args.temperature,
-                    top_p=script_args.top_p,
-                )
-                output_text = response.choices[0].message.content
-                break
-            except Exception as e:
-                if num_retries < max_retries:
-                    num_retries += 1
-                    time.sleep(30)
-                    continue
-                else:
-                    print(f"Error processing example: {e}")
-                    output_text = f"ERRORED ({e})"
-                    break
-        return {
-            "input": input_text,
-            "output_synthetic": output_text,
-            "output_gt": output_text_gt,
-        }
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        results = list(tqdm(executor.map(process_example_azure, dataset), total=len(dataset)))
-
-elif script_args.model_type == "vllm":
-    results = []
-
-    def process_example_vllm(example):
-        input_text = example["input"]
-        output_text_gt = example["output"]
-        try:
-            response = completion(
-                model=f"hosted_vllm/{script_args.model_id}",
-                messages=[
+    sampling_params = SamplingParams(
+        n=num_samples,
+        temperature=script_args.temperature if script_args.do_sample else 0.0,
+        top_p=script_args.top_p,
+        top_k=script_args.top_k,
+        min_p=script_args.min_p,
+        max_tokens=script_args.max_new_tokens,
+        stop=stop_sequences,
+        include_stop_str_in_output=True,
+    )
+
+    # same truncation as the local backend
+    input_texts = dataset["input"]
+    output_texts_gt = dataset["output"]
+    vllm_tokenizer = llm.get_tokenizer()
+    vllm_tokenizer.truncation_side = "left"
+    encodings = vllm_tokenizer(
+        [input_texts[idx] for idx in todo_indices],
+        truncation=True,
+        max_length=script_args.max_seq_length,
+    )
+
+    # the engine batches continuously within a chunk; chunks only bound the work lost on a crash
+    chunk_size = getattr(script_args, "vllm_chunk_size", 4096)
+    metrics = GenerationMetrics(script_args.model_type)
+    for chunk_start in tqdm(range(0, len(todo_indices), chunk_size)):
+        chunk_positions = range(chunk_start, min(chunk_start + chunk_size, len(todo_indices)))
+        request_outputs = llm.generate(
+            [{"prompt_token_ids": encodings["input_ids"][pos]} for pos in chunk_positions],
+            sampling_params,
+        )
+        for pos, request_output in zip(chunk_positions, request_outputs):
+            idx = todo_indices[pos]
+            write_samples(idx, [{
+                "input": input_texts[idx],
+                "output_synthetic": completion_output.text,
+                "output_gt": output_texts_gt[idx],
+                "sample_index": completion_output.index,
+                "completion_tokens": len(completion_output.token_ids),
+            } for completion_output in sorted(request_output.outputs, key=lambda output: output.index)])
+            # engine-side timestamps (wall clock); not every vLLM version reports them
+            request_metrics = getattr(request_output, "metrics", None)
+            arrival_time = getattr(request_metrics, "arrival_time", None)
+            first_token_time = getattr(request_metrics, "first_token_time", None)
+            finished_time = getattr(request_metrics, "finished_time", None) or getattr(request_metrics, "last_token_time", None)
+            metrics.record(
+                idx,
+                queue_time=getattr(request_metrics, "time_in_queue", None),
+                ttft=first_token_time - arrival_time if arrival_time and first_token_time else None,
+                latency=finished_time - arrival_time if arrival_time and finished_time else None,
+                prompt_tokens=len(request_output.prompt_token_ids),
+                completion_tokens=sum(len(output.token_ids) for output in request_output.outputs),
+            )
+
+elif script_args.model_type in ("azure_openai", "vllm"):
+    max_concurrency = getattr(script_args, "max_concurrency", 128)
+    http_client = make_http_client(max_concurrency)
+    if script_args.model_type == "azure_openai":
+        client = AsyncAzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_API_BASE"),
+            api_key=os.getenv("AZURE_API_KEY"),
+            api_version=os.getenv("AZURE_API_VERSION"),
+            max_retries=0,
+            http_client=http_client,
+        )
+        def make_request(example):
+            return {
+                "model": script_args.model_id,
+                "messages": [
+                    {"role": "system", "content": [{"type": "text", "text": script_args.system_prompt}]},
+                    {"role": "user", "content": [{"type": "text", "text": example["input"]}]}
+                ],
+                "max_tokens": script_args.max_new_tokens,
+                "temperature": script_args.temperature,
+                "top_p": script_args.top_p,
+                "n": num_samples,
+                "stop": stop_sequences or None,
+            }
+        def parse_choice(choice):
+            # Azure drops the matched stop sequence; restore the closing tag extraction relies on
+            text = choice.message.content or ""
+            if choice.finish_reason == "stop" and "</code>" in stop_sequences and text.count("<code>") > text.count("</code>"):
+                text += "</code>"
+            return text
+    else:
+        parse_choice = None
+        client = AsyncOpenAI(
+            base_url=script_args.api_base,
+            api_key=os.getenv("VLLM_API_KEY", "EMPTY"),
+            max_retries=0,
+            http_client=http_client,
+        )
+        def make_request(example):
+            return {
+                "model": script_args.model_id,
+                "messages": [
                     {"role": "system", "content": script_args.system_prompt},
-                    {"role": "user", "content": input_text}
+                    {"role": "user", "content": example["input"]}
                 ],
-                api_base=script_args.api_base,
-                max_tokens=script_args.max_new_tokens,
-                temperature=script_args.temperature,
-                top_p=script_args.top_p,
-                top_k=script_args.top_k,
-                min_p=script_args.min_p,
-            )
-            output_text = response["choices"][0]["message"]["content"]
-        except Exception as e:
-            print(f"Error processing example: {e}")
-            output_text = f"ERRORED ({e})"
-        return {
-            "input": input_text,
-            "output_synthetic": output_text,
-            "output_gt": output_text_gt,
-        }
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        results = list(tqdm(executor.map(process_example_vllm, dataset), total=len(dataset)))
+                "max_tokens": script_args.max_new_tokens,
+                "temperature": script_args.temperature,
+                "top_p": script_args.top_p,
+                "n": num_samples,
+                "stop": stop_sequences or None,
+                "extra_body": {
+                    "top_k": script_args.top_k,
+                    "min_p": script_args.min_p,
+                    "include_stop_str_in_output": True,
+                },
+            }
+
+    engine = APIGenerationEngine(
+        client,
+        make_request,
+        parse_choice=parse_choice,
+        initial_concurrency=getattr(script_args, "initial_concurrency", 16),
+        min_concurrency=getattr(script_args, "min_concurrency", 1),
+        max_concurrency=max_concurrency,
+        max_retries=getattr(script_args, "max_retries", 5),
+        tokens_per_minute=getattr(script_args, "tokens_per_minute", None),
+        requests_per_minute=getattr(script_args, "requests_per_minute", None),
+    )
+    metrics = GenerationMetrics(script_args.model_type)
+    progress = tqdm(total=len(todo_indices))
+    def on_result(idx, results, stats):
+        write_samples(idx, results)
+        metrics.record(idx, **stats)
+        progress.update(1)
+    asyncio.run(engine.run(((idx, dataset[idx]) for idx in todo_indices), on_result))
+    progress.close()
 
 else:
     raise ValueError(f"Model type {script_args.model_type} not supported")
 
-with open(script_args.output_data_path, "w") as f:
-    for result in results:
-        f.write(json.dumps(result, ensure_ascii=False) + "\n")
-        
-print(f"Results saved to {script_args.output_data_path}")
+writer.close()
+metrics.print_summary()
+metrics_path = getattr(script_args, "metrics_path", None) or script_args.output_data_path + ".metrics.json"
+metrics.save(metrics_path)
+print(f"Metrics saved to {metrics_path}")
+if writer.is_complete():
+    print(f"Results saved to {script_args.output_data_path}")
+else:
+    print(f"Partial results saved to {script_args.output_data_path}; rerun to resume")
+if writer.num_failed:
+    print(f"{writer.num_failed} results failed after all retries; rerun to retry them")
@@ -1,139 +1,324 @@
-import re
-from templates import *
-
-def process_instructions(instructions):
-    instructions = re.sub(r"\n+", "\n", instructions)
-    return instructions.strip()
-
-def process_stage(stage, prompt_template="ft"):
-    if prompt_template == "ft":
-        return " ".join(stage.split("_")).upper()
-    else:
-        mapping = {
-            "submission_q0": "first",
-            "submission_q1": "mid-point",
-            "submission_q2": "final",    
-        }
-        return mapping[stage]
+import os
+import sys
+import json
+import time
+import bisect
 
+# the prompt-rendering package (prompts/) is installed with `pip install -e .` from the
+# repository root; a checkout that hasn't been installed imports it from there
+try:
+    from prompts import *
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from prompts import *
 
 ########################################################
-# EXPERIMENT 1
+# DATASET
 ########################################################
 
-##################
-# without context
-##################
-
-def process_input_exp1_without_context(example, prompt_template="ft"):
-    input = example["INPUT"]
-    template = EXP_1_WITHOUT_CONTEXT_INPUT_TEMPLATE_FT if prompt_template == "ft" else EXP_1_WITHOUT_CONTEXT_INPUT_TEMPLATE_PROMPTING
-    processed_input = template.format(
-        instructions=process_instructions(input["instructions"]),
-        fixed_code=input["skeleton_code_fixed"].strip(),
-        skeleton_code=input["skeleton_code_todo"].strip(),
-        timestamp=process_stage(input["stage"], prompt_template)
-    )
-    return {"input": processed_input}
-
-def process_output_exp1_without_context(example):
-    student_code = f"<code>{example['OUTPUT'].strip()}</code>"
-    return {"output": student_code}
-
-
-##################
-# with context
-##################
-
-def process_past_problem_submissions_exp1_with_context(example):
-    past_problem_submissions = example["past_problem_submissions"]
-    processed_past_submissions = ""
-    for submission in past_problem_submissions:
-        processed_past_submissions += (f"PROBLEM NAME: {submission['question_name']}\n"
-                                       f"<code>{submission['submission'].strip()}</code>\n\n")
-    return processed_past_submissions.strip()
-
-def process_input_exp1_with_context(example, prompt_template="ft"):
-    input = example["INPUT"]
-    template = EXP_1_WITH_CONTEXT_INPUT_TEMPLATE_FT if prompt_template == "ft" else EXP_1_WITH_CONTEXT_INPUT_TEMPLATE_PROMPTING
-    processed_input = template.format(
-        past_problem_submissions=process_past_problem_submissions_exp1_with_context(input),
-        instructions=process_instructions(input["instructions"]),
-        fixed_code=input["skeleton_code_fixed"].strip(),
-        skeleton_code=input["skeleton_code_todo"].strip(),
-        timestamp=process_stage(input["stage"], prompt_template)
+def prepare_dataset(script_args):
+    """Render the prompts of a generation config, as generate.py sends them."""
+    # with-context prompts keep the most recent past submissions that fit the token budget
+    # (default: max_seq_length, where the local backends would otherwise truncate)
+    packer = None
+    context_token_budget = getattr(script_args, "context_token_budget", getattr(script_args, "max_seq_length", None))
+    if context_token_budget is not None and script_args.experiment_name in PAST_PROBLEM_SUBMISSION_ENTRY_FUNCTIONS:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(
+            getattr(script_args, "tokenizer_id", script_args.model_id),
+            trust_remote_code=True,
+        )
+        packer = ContextPacker(tokenizer, context_token_budget)
+    return load_prompt_dataset(
+        script_args.input_data_path,
+        script_args.experiment_name,
+        script_args.prompt_template,
+        cache_dir=getattr(script_args, "prompt_cache_dir", "../data/prompt_cache"),
+        num_proc=getattr(script_args, "num_proc", None),
+        packer=packer,
     )
-    return {"input": processed_input}
 
-def process_output_exp1_with_context(example):
-    student_code = f"<code>{example['OUTPUT'].strip()}</code>"
-    return {"output": student_code}
+########################################################
+# BATCHING
+########################################################
+
+def build_token_budget_batches(lengths, max_batch_tokens, extra_tokens=0, max_batch_size=None):
+    """
+    Group example indices into batches of similar length. Examples are sorted by
+    length (longest first) and a batch is closed once its padded size,
+    batch_size * (longest prompt + extra_tokens), would exceed max_batch_tokens.
+    """
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx], reverse=True)
+    batches = []
+    batch, batch_max_length = [], 0
+    for idx in order:
+        new_max_length = max(batch_max_length, lengths[idx])
+        too_many_tokens = (len(batch) + 1) * (new_max_length + extra_tokens) > max_batch_tokens
+        too_many_examples = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (too_many_tokens or too_many_examples):
+            batches.append(batch)
+            batch, new_max_length = [], lengths[idx]
+        batch.append(idx)
+        batch_max_length = new_max_length
+    if batch:
+        batches.append(batch)
+    return batches
 
 
 ########################################################
-# EXPERIMENT 2
+# SCHEDULING
 ########################################################
 
-##################
-# without context
-##################
-
-def process_curr_problem_prior_submissions_exp2_without_context(example):
-    curr_problem_prior_submissions = example["curr_problem_prior_submissions"]
-    processed_curr_submissions = ""
-    for submission in curr_problem_prior_submissions:
-        processed_curr_submissions += f"<code>{submission.strip()}</code>"
-    return processed_curr_submissions
-
-def process_input_exp2_without_context(example, prompt_template="ft"):
-    input = example["INPUT"]
-    template = EXP_2_WITHOUT_CONTEXT_INPUT_TEMPLATE_FT if prompt_template == "ft" else EXP_2_WITHOUT_CONTEXT_INPUT_TEMPLATE_PROMPTING
-    processed_input = template.format(
-        instructions=process_instructions(input["instructions"]),
-        fixed_code=input["skeleton_code_fixed"].strip(),
-        skeleton_code=input["skeleton_code_todo"].strip(),
-        curr_problem_prior_submissions=process_curr_problem_prior_submissions_exp2_without_context(input)
-    )
-    return {"input": processed_input}
-
-def process_output_exp2_without_context(example):
-    student_code = f"<code>{example['OUTPUT'].strip()}</code>"
-    return {"output": student_code}
-
-
-##################
-# with context
-##################
-
-def process_past_problem_submissions_exp2_with_context(example):
-    past_problem_submissions = example["past_problem_submissions"]
-    processed_past_submissions = ""
-    for submission in past_problem_submissions:
-        processed_past_submissions += (f"PROBLEM NAME: {submission['question_name']}\n")
-        for submission_t in submission["submissions"]:
-            processed_past_submissions += f"<code>{submission_t.strip()}</code>"
-        processed_past_submissions += "\n\n"
-    return processed_past_submissions.strip()
-
-def process_curr_problem_prior_submissions_exp2_with_context(example):
-    curr_problem_prior_submissions = example["curr_problem_prior_submissions"]
-    processed_curr_submissions = ""
-    for submission_t in curr_problem_prior_submissions:
-        processed_curr_submissions += f"<code>{submission_t.strip()}</code>"
-    return processed_curr_submissions
-
-def process_input_exp2_with_context(example, prompt_template="ft"):
-    input = example["INPUT"]
-    template = EXP_2_WITH_CONTEXT_INPUT_TEMPLATE_FT if prompt_template == "ft" else EXP_2_WITH_CONTEXT_INPUT_TEMPLATE_PROMPTING
-    processed_input = template.format(
-        past_problem_submissions=process_past_problem_submissions_exp2_with_context(input),
-        instructions=process_instructions(input["instructions"]),
-        fixed_code=input["skeleton_code_fixed"].strip(),
-        skeleton_code=input["skeleton_code_todo"].strip(),
-        curr_problem_prior_submissions=process_curr_problem_prior_submissions_exp2_with_context(input)
-    )
-    return {"input": processed_input}
+def common_prefix_length(a, b):
+    # binary search over slice comparisons (done in C) rather than a per-character loop
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+def order_by_shared_prefix(prompts, indices=None):
+    """
+    Order `indices` (default: all) so that prompts sharing a prefix are sent
+    back to back. Sorting the prompts lexicographically visits them in the
+    order of a depth-first walk of their prefix trie: rows of the same student
+    (past submissions block) and question (instructions, skeleton) end up
+    adjacent, which is what a prefix cache needs to get hits.
+    """
+    if indices is None:
+        indices = range(len(prompts))
+    return sorted(indices, key=lambda idx: prompts[idx])
+
+def prefix_reuse_ratio(prompts, order, cache_size=1):
+    """
+    Fraction of prompt tokens (or characters, for strings) that a prefix cache
+    holding the last `cache_size` prompts could serve when sending `prompts` in
+    `order`: each prompt reuses its longest common prefix with a cached prompt.
+    """
+    window = []  # cached prompts, kept sorted so the best match is a neighbor
+    reused, total = 0, 0
+    for position, idx in enumerate(order):
+        prompt = prompts[idx]
+        insert_at = bisect.bisect_left(window, prompt)
+        neighbors = window[max(0, insert_at - 1):insert_at + 1]
+        reused += max((common_prefix_length(prompt, other) for other in neighbors), default=0)
+        total += len(prompt)
+        window.insert(insert_at, prompt)
+        if len(window) > cache_size:
+            window.remove(prompts[order[position - cache_size]])
+    return reused / total if total else 0.0
+
+
+########################################################
+# OUTPUT
+########################################################
+
+def is_failed_result(result):
+    # rows of requests that failed after all retries (see api_engine.py)
+    return isinstance(result, dict) and str(result.get("output_synthetic", "")).startswith("ERRORED")
+
+class ResultWriter:
+    """
+    Buffered writer that streams results to `output_path` in dataset order.
+    Results that finish ahead of the next index in order are journaled (with
+    their index) to `<output_path>.pending` until the gap closes, so every
+    finished result survives a crash; only their positions in the journal are
+    kept in memory. Reopening the writer on the same path resumes:
+    `remaining()` lists the indices that still need to be generated, including
+    those whose result failed (`is_failed_result`).
+    """
+
+    def __init__(self, output_path, num_examples, flush_interval=1.0):
+        self.output_path = output_path
+        self.pending_path = output_path + ".pending"
+        self.num_examples = num_examples
+        self.flush_interval = flush_interval
+
+        # results already in order; a torn last line is dropped
+        self.next_index = 0
+        self.num_failed = 0
+        if os.path.exists(output_path):
+            self._reopen_output()
+
+        # results journaled out of order: index -> (offset, length) in the journal
+        self.pending = {}
+        self._compact_journal()
+
+        self.output_file = open(output_path, "a", encoding="utf-8")
+        self.pending_file = open(self.pending_path, "ab")
+        self.pending_reader = open(self.pending_path, "rb")
+        self.last_flush = time.monotonic()
+        self._drain()
+        self.flush()
+
+    def _reopen_output(self):
+        # results before the first failed one stay in the output; later ones move to
+        # the journal and failed ones are dropped, so they are generated again
+        keep_size = 0
+        found_failed = False
+        with open(self.output_path, "rb") as f, open(self.pending_path, "ab") as journal:
+            for index, line in enumerate(f):
+                if not line.endswith(b"\n"):
+                    break
+                if b"ERRORED" in line and is_failed_result(json.loads(line)):
+                    found_failed = True
+                elif found_failed:
+                    journal.write(b'{"index": %d, "result": %s}\n' % (index, line.rstrip(b"\n")))
+                else:
+                    keep_size += len(line)
+                    self.next_index += 1
+        os.truncate(self.output_path, keep_size)
+
+    def _compact_journal(self):
+        # rewrite the journal without entries that are already in order, torn or
+        # failed (those are generated again), one entry at a time
+        if not os.path.exists(self.pending_path):
+            return
+        tmp_path = f"{self.pending_path}.tmp{os.getpid()}"
+        with open(self.pending_path, "rb") as src, open(tmp_path, "wb") as dst:
+            for line in src:
+                if not line.endswith(b"\n"):
+                    continue
+                try:
+                    entry = json.loads(line)
+                    index = entry["index"]
+                except (json.JSONDecodeError, KeyError):
+                    continue
+                if is_failed_result(entry.get("result")):
+                    continue
+                if index >= self.next_index and index not in self.pending:
+                    self.pending[index] = (dst.tell(), len(line))
+                    dst.write(line)
+        os.replace(tmp_path, self.pending_path)
+
+    def _read_pending(self, index):
+        offset, length = self.pending.pop(index)
+        self.pending_reader.seek(offset)
+        return json.loads(self.pending_reader.read(length))["result"]
+
+    def _drain(self):
+        if self.next_index in self.pending:
+            self.pending_file.flush()
+        while self.next_index in self.pending:
+            result = self._read_pending(self.next_index)
+            self.output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+            self.next_index += 1
+
+    def is_done(self, index):
+        return index < self.next_index or index in self.pending
+
+    def remaining(self):
+        return [idx for idx in range(self.num_examples) if not self.is_done(idx)]
+
+    def is_complete(self):
+        return self.next_index >= self.num_examples
+
+    def write(self, index, result):
+        if self.is_done(index):
+            return
+        if is_failed_result(result):
+            self.num_failed += 1
+        if index == self.next_index:
+            self.output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+            self.next_index += 1
+            self._drain()
+        else:
+            line = (json.dumps({"index": index, "result": result}, ensure_ascii=False) + "\n").encode("utf-8")
+            self.pending[index] = (self.pending_file.tell(), len(line))
+            self.pending_file.write(line)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.output_file.flush()
+        self.pending_file.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.output_file.close()
+        self.pending_file.close()
+        self.pending_reader.close()
+        if self.is_complete() or not self.pending:
+            os.remove(self.pending_path)
+
+
+########################################################
+# METRICS
+########################################################
+
+def percentile(values, q):
+    """Linearly interpolated `q`-th percentile (0-100) of a non-empty list."""
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+class GenerationMetrics:
+    """
+    Per-request timings (seconds) and token counts for one generation run. A
+    request is one prompt (with all of its samples). `ttft` and `queue_time`
+    are None where the backend does not expose them.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.requests = []
+        self.start = time.monotonic()
+
+    def record(self, index, queue_time=None, ttft=None, latency=None,
+               prompt_tokens=None, completion_tokens=None, retries=0):
+        self.requests.append({
+            "index": index,
+            "queue_time": queue_time,
+            "ttft": ttft,
+            "latency": latency,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "retries": retries,
+        })
+
+    def summary(self):
+        wall_time = time.monotonic() - self.start
+        prompt_tokens = sum(request["prompt_tokens"] or 0 for request in self.requests)
+        completion_tokens = sum(request["completion_tokens"] or 0 for request in self.requests)
+        summary = {
+            "backend": self.backend,
+            "num_requests": len(self.requests),
+            "wall_time": wall_time,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "completion_tokens_per_s": completion_tokens / wall_time if wall_time else 0.0,
+            "total_tokens_per_s": (prompt_tokens + completion_tokens) / wall_time if wall_time else 0.0,
+            "retries": sum(request["retries"] for request in self.requests),
+        }
+        for key in ("queue_time", "ttft", "latency"):
+            values = [request[key] for request in self.requests if request[key] is not None]
+            if values:
+                summary[key] = {
+                    "mean": sum(values) / len(values),
+                    "p50": percentile(values, 50),
+                    "p95": percentile(values, 95),
+                    "p99": percentile(values, 99),
+                }
+        return summary
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"summary": self.summary(), "requests": self.requests}, f, indent=2)
 
-def process_output_exp2_with_context(example):
-    student_code = f"<code>{example['OUTPUT'].strip()}</code>"
-    return {"output": student_code}
+    def print_summary(self):
+        summary = self.summary()
+        print(f"{summary['num_requests']} requests in {summary['wall_time']:.1f}s "
+              f"({summary['prompt_tokens']} prompt / {summary['completion_tokens']} completion tokens, "
+              f"{summary['retries']} retries)")
+        print(f"throughput: {summary['completion_tokens_per_s']:.1f} completion tokens/s, "
+              f"{summary['total_tokens_per_s']:.1f} total tokens/s")
+        for key in ("queue_time", "ttft", "latency"):
+            if key in summary:
+                stats = summary[key]
+                print(f"{key}: p50 {stats['p50']:.3f}s, p95 {stats['p95']:.3f}s, p99 {stats['p99']:.3f}s")
@@ -4,17 +4,31 @@ import pycodestyle
 from tqdm import tqdm
 import os
 import argparse
-import signal
 import warnings
 import multiprocessing as mp
 mp.set_start_method("fork")
 
-from autograder import Autograder
+from concurrent.futures import ProcessPoolExecutor
+
+from autograder import Autograder, GradingTimeout, canonicalize_code, get_grading_cache
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--input_dir", required=True)
 parser.add_argument("--output_dir", required=True)
+parser.add_argument("--cache_path", default="../data/grading_cache.sqlite")
+parser.add_argument("--canonicalize", action="store_true",
+                    help="grade code that differs only in comments or formatting once")
+parser.add_argument("--submission_budget", type=float, default=30,
+                    help="maximum grading time per code block in seconds")
+parser.add_argument("--pep8_select", default=None,
+                    help="comma-separated pycodestyle codes to check (default: pycodestyle's default set)")
+parser.add_argument("--num_workers", type=int, default=os.cpu_count() or 1,
+                    help="grading processes (0 or 1: grade in this process)")
+parser.add_argument("--chunk_size", type=int, default=64,
+                    help="rows per task; progress is checkpointed after every chunk")
 args = parser.parse_args()
+if args.num_workers < 0:
+    parser.error("--num_workers must be >= 0")
 
 INPUT_DIR  = args.input_dir
 OUTPUT_DIR = args.output_dir
@@ -26,10 +40,6 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 warnings.filterwarnings("ignore", message=".*optimum is not installed.*")
-style_guide     = pycodestyle.StyleGuide(quiet=True)
-
-def _timeout_handler(signum, frame):
-    raise TimeoutError("entry timed out")
 
 test_class_map = {}
 for fname in os.listdir(TEST_CLASS_DIR):
@@ -45,64 +55,159 @@ for fname in os.listdir(TEST_CLASS_DIR):
 
 feature_cache = {}
 
-class CaptureReport(pycodestyle.BaseReport):
-    def __init__(self, options):
-        super().__init__(options)
-        self.errors = []
+class CodeCountReport(pycodestyle.BaseReport):
+    """Counts the error codes of the snippet currently being checked."""
+
+    def init_file(self, filename, lines, expected, line_offset):
+        self.codes = {}
+        return super().init_file(filename, lines, expected, line_offset)
 
     def error(self, line_number, offset, text, check):
         code = super().error(line_number, offset, text, check)
         if code:
-            self.errors.append({
-                "line": line_number,
-                "col": offset,
-                "msg": text
-            })
+            self.codes[code] = self.codes.get(code, 0) + 1
         return code
 
+class StyleChecker:
+    """
+    Batched pycodestyle engine. The style guide, the registered check functions,
+    the report and the checker are set up once and reused for every snippet;
+    `select` limits the checks that run at all.
+    """
+
+    def __init__(self, select=None):
+        if select:
+            self.style_guide = pycodestyle.StyleGuide(quiet=True, select=select)
+        else:
+            self.style_guide = pycodestyle.StyleGuide(quiet=True)
+        self.report = CodeCountReport(self.style_guide.options)
+        self.checker = pycodestyle.Checker(options=self.style_guide.options, report=self.report)
+
+    def check(self, code):
+        # snippets are checked as the body of a function
+        lines = ["def _tmp_func():"]
+        lines.extend(f"    {line.rstrip()}" for line in code.strip().splitlines())
+
+        self.checker.lines = lines
+        self.checker._checker_states = {}
+        self.checker.check_all()
+        return {
+            "count": self.report.file_errors,
+            "codes": self.report.codes
+        }
+
+    def check_batch(self, codes):
+        return [self.check(code) for code in codes]
+
+style_checker = StyleChecker(args.pep8_select.split(",") if args.pep8_select else None)
+
 def count_pep8_violations(code):
-    if not code.endswith('\n'):
-        code += '\n'
+    return style_checker.check(code)
+
+
+# node types counted in the per-snippet histogram
+AST_NODE_CATEGORIES = {
+    ast.For: "loops",
+    ast.AsyncFor: "loops",
+    ast.While: "loops",
+    ast.ListComp: "comprehensions",
+    ast.SetComp: "comprehensions",
+    ast.DictComp: "comprehensions",
+    ast.GeneratorExp: "comprehensions",
+    ast.If: "conditionals",
+    ast.IfExp: "conditionals",
+    ast.FunctionDef: "functions",
+    ast.AsyncFunctionDef: "functions",
+    ast.Lambda: "lambdas",
+    ast.Return: "returns",
+    ast.Call: "calls",
+    ast.Try: "try_blocks",
+}
+
+def get_ast_metrics(code):
+    """
+    Depth, width, node count, average branching and a node-type histogram of
+    the AST, computed in one iterative pass (no recursion limit on deep code).
+    """
+    try:
+        tree = ast.parse(code.strip())
+    except:
+        return {
+            "ast_depth": -1,
+            "ast_width": -1,
+            "ast_node_count": -1,
+            "ast_avg_branching": -1,
+            "ast_node_types": None
+        }
+
+    node_types = dict.fromkeys(AST_NODE_CATEGORIES.values(), 0)
+    node_types["recursive_calls"] = 0
+    widths = []
+    node_count = total_children = non_leaf = 0
+
+    # (node, depth, name of the enclosing function)
+    stack = [(tree, 0, None)]
+    while stack:
+        node, depth, func_name = stack.pop()
+        if depth == len(widths):
+            widths.append(0)
+        widths[depth] += 1
+        node_count += 1
 
-    wrapper = "def _tmp_func():\n"
-    for line in code.strip().splitlines():
-        wrapper += f"    {line.rstrip()}\n"
+        node_type = type(node)
+        category = AST_NODE_CATEGORIES.get(node_type)
+        if category is not None:
+            node_types[category] += 1
+        if node_type is ast.FunctionDef or node_type is ast.AsyncFunctionDef:
+            func_name = node.name
+        elif node_type is ast.Call and type(node.func) is ast.Name and node.func.id == func_name:
+            node_types["recursive_calls"] += 1
+
+        num_children = 0
+        for child in ast.iter_child_nodes(node):
+            stack.append((child, depth + 1, func_name))
+            num_children += 1
+        total_children += num_children
+        if num_children:
+            non_leaf += 1
 
-    report = CaptureReport(style_guide.options)
-    checker = pycodestyle.Checker(
-        lines=wrapper.splitlines(),
-        report=report
-    )
-    checker.check_all()
     return {
-        "count": checker.report.total_errors,
-        "messages": report.errors
+        "ast_depth": len(widths) - 1,
+        "ast_width": max(widths),
+        "ast_node_count": node_count,
+        "ast_avg_branching": total_children / non_leaf if non_leaf else 0,
+        "ast_node_types": node_types
     }
 
+def get_ast_metrics_batch(codes):
+    return [get_ast_metrics(code) for code in codes]
 
 def get_ast_tree_metrics(code):
-    try:
-        tree = ast.parse(code.strip())
-    except:
-        return -1, -1, -1, -1
-
-    max_depth = node_count = total_children = non_leaf = 0
-    widths = {}
-    def visit(node, depth=0):
-        nonlocal max_depth, node_count, total_children, non_leaf
-        max_depth = max(max_depth, depth)
-        widths[depth] = widths.get(depth, 0) + 1
-        node_count += 1
-        children = list(ast.iter_child_nodes(node))
-        total_children += len(children)
-        if children:
-            non_leaf += 1
-        for c in children:
-            visit(c, depth+1)
-    visit(tree)
-    avg_branch = total_children / non_leaf if non_leaf else 0
-    max_width  = max(widths.values()) if widths else 0
-    return max_depth, max_width, node_count, avg_branch
+    metrics = get_ast_metrics(code)
+    return metrics["ast_depth"], metrics["ast_width"], metrics["ast_node_count"], metrics["ast_avg_branching"]
+
+def extract_features_batch(codes):
+    """Extract features for many snippets, computing those of new snippets in one batch."""
+    new_codes = list(dict.fromkeys(
+        code.strip() for code in codes
+        if code.strip() and code.strip().upper() != "NONE" and code.strip() not in feature_cache
+    ))
+    pep8_batch = style_checker.check_batch(new_codes)
+    ast_batch = get_ast_metrics_batch(new_codes)
+    for code, pep8, ast_metrics in zip(new_codes, pep8_batch, ast_batch):
+        feature_cache[code] = build_features(code, pep8, ast_metrics)
+    return [extract_features(code) for code in codes]
+
+def build_features(cleaned, pep8, ast_metrics=None):
+    if ast_metrics is None:
+        ast_metrics = get_ast_metrics(cleaned)
+    feat = {
+        "loc": cleaned.count("\n") + 1,
+        "char_count": len(cleaned),
+        "pep8_violations": pep8
+    }
+    feat.update(ast_metrics)
+    return feat
 
 def extract_features(code: str):
     key = code.strip()
@@ -112,104 +217,181 @@ def extract_features(code: str):
         return feature_cache[key]
 
     cleaned = code.strip()
-    depth, width, nodes, branch = get_ast_tree_metrics(code)
-
-    feat = {
-        "loc": cleaned.count("\n") + 1,
-        "char_count": len(cleaned),
-        "pep8_violations": count_pep8_violations(cleaned),
-        "ast_depth": depth,
-        "ast_width": width,
-        "ast_node_count": nodes,
-        "ast_avg_branching": branch
-    }
+    feat = build_features(cleaned, count_pep8_violations(cleaned))
     feature_cache[key] = feat
     return feat
 
-if __name__ == "__main__":
-    for filename in os.listdir(INPUT_DIR):
+def grade(code, test_path):
+    grading_cache = get_grading_cache(args.cache_path, args.canonicalize)
+    return Autograder.grade_submission_cached(code, test_path, grading_cache, budget=args.submission_budget)
 
-        in_path  = os.path.join(INPUT_DIR,  filename)
-        out_path = os.path.join(
-            OUTPUT_DIR,
-            filename.replace("_formatted", "_with_features")
-        )
+def grade_block(task):
+    """Grade a (code, test path) pair; None if it exceeds the submission budget."""
+    code, test_path = task
+    try:
+        return grade(code, test_path)
+    except GradingTimeout:
+        return None
 
-        if os.path.exists(out_path):
-            print(f"Skipping {filename} — already processed.")
+def grading_group_key(code, test_path):
+    # code blocks with the same canonical form grade the same against a test file
+    canonical = canonicalize_code(code)
+    if canonical is None:
+        return ("text", code.strip(), test_path)
+    return ("ast", canonical, test_path)
+
+def code_block_keys(filename):
+    if "_1_" in filename or "_3_" in filename:
+        return [f"{side}_code_block" for side in ["synthetic", "gt"]]
+    if "_2_" in filename:
+        return [f"{side}_code_block_q{i}" for i in range(3) for side in ["synthetic", "gt"]]
+    return []
+
+def get_test_path(row):
+    return os.path.join(TEST_FILES_DIR, f"{row['semester']}_{row['question_name']}.py")
+
+def iter_code_blocks(rows, filename):
+    """(code, test path) of every code block of `rows` that gets metrics."""
+    for row in rows:
+        if is_skipped(row):
             continue
+        test_path = get_test_path(row)
+        for key in code_block_keys(filename):
+            code = row.get(key, "").strip()
+            if code and code.upper() != "NONE":
+                yield code, test_path
+
+def add_block_metrics(row, key, test_path, grades=None):
+    code = row.get(key, "").strip()
+    if code == "" or code.upper() == "NONE":
+        row[f"{key}_features"] = None
+        row[f"{key}_autograder"] = None
+        row[f"{key}_status"] = None
+        return
+
+    row[f"{key}_features"] = extract_features(code)
+    if grades is not None:
+        result = grades[grading_group_key(code, test_path)]
+    else:
+        result = grade_block((code, test_path))
+    row[f"{key}_autograder"] = result
+    row[f"{key}_status"] = "graded" if result is not None else "timed_out"
+
+def is_skipped(row):
+    return row["question_name"] == "Mint" or row.get("is_processed") is False
+
+def process_row(row, filename, grades=None):
+    if is_skipped(row):
+        return row
+
+    tc = test_class_map.get((row["student_id"], row["question_name"]), None)
+    test_path = get_test_path(row)
+    for key in code_block_keys(filename):
+        add_block_metrics(row, key, test_path, grades)
+
+    new_row = {"test_class": tc}
+    for k, v in row.items():
+        new_row[k] = v
+    return new_row
+
+def process_chunk(task):
+    filename, rows, grades = task
+    extract_features_batch([
+        row[key] for row in rows if not is_skipped(row) for key in row
+        if key.startswith(("gt_code_block", "synthetic_code_block")) and isinstance(row[key], str)
+    ])
+    return [process_row(row, filename, grades) for row in rows]
+
+def grade_groups(rows, filename, executor):
+    """
+    Grade one representative code block per (canonical form, test file) group
+    in `rows`, in parallel, and return the results by group key. Equivalent
+    code blocks are then never graded concurrently by different workers.
+    """
+    groups = {}
+    for code, test_path in iter_code_blocks(rows, filename):
+        groups.setdefault(grading_group_key(code, test_path), (code, test_path))
+    tasks = list(groups.values())
+    if executor is not None:
+        results = executor.map(grade_block, tasks, chunksize=max(1, len(tasks) // (4 * args.num_workers)))
+    else:
+        results = map(grade_block, tasks)
+    return dict(zip(groups, tqdm(results, total=len(tasks), desc=f"{filename} (grading)")))
+
+########################################################
+# checkpointing
+########################################################
+
+def load_checkpoint(progress_path):
+    """Number of rows and bytes already written to the partial output."""
+    if not os.path.exists(progress_path):
+        return 0, 0
+    with open(progress_path) as f:
+        progress = json.load(f)
+    return progress["rows"], progress["bytes"]
+
+def save_checkpoint(progress_path, rows, num_bytes):
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"rows": rows, "bytes": num_bytes}, f)
+    os.replace(tmp_path, progress_path)
+
+def process_file(filename, executor):
+    in_path  = os.path.join(INPUT_DIR,  filename)
+    out_path = os.path.join(
+        OUTPUT_DIR,
+        filename.replace("_formatted", "_with_features")
+    )
+    partial_path  = out_path + ".partial"
+    progress_path = out_path + ".progress"
+
+    if os.path.exists(out_path):
+        print(f"Skipping {filename} — already processed.")
+        return
+
+    with open(in_path) as f:
+        data = [json.loads(line) for line in f if line.strip()]
+
+    rows_done, num_bytes = load_checkpoint(progress_path)
+    if rows_done:
+        print(f"Resuming {filename} at row {rows_done}.")
+
+    grades = None
+    if args.canonicalize:
+        grades = grade_groups(data[rows_done:], filename, executor)
+
+    tasks = []
+    for i in range(rows_done, len(data), args.chunk_size):
+        rows = data[i:i + args.chunk_size]
+        # only the grades of this chunk's code blocks are sent to the worker
+        chunk_grades = None
+        if grades is not None:
+            chunk_grades = {
+                group_key: grades[group_key]
+                for group_key in (grading_group_key(code, test_path) for code, test_path in iter_code_blocks(rows, filename))
+            }
+        tasks.append((filename, rows, chunk_grades))
+    chunks = executor.map(process_chunk, tasks) if executor else map(process_chunk, tasks)
+
+    # results arrive in row order; drop anything written after the last checkpoint
+    with open(partial_path, "ab") as f, tqdm(total=len(data), initial=rows_done, desc=filename) as pbar:
+        f.truncate(num_bytes)
+        for results in chunks:
+            f.write("".join(json.dumps(row) + "\n" for row in results).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+            rows_done += len(results)
+            save_checkpoint(progress_path, rows_done, f.tell())
+            pbar.update(len(results))
+
+    os.replace(partial_path, out_path)
+    os.remove(progress_path)
 
-        with open(in_path) as f:
-            data = [json.loads(line) for line in f if line.strip()]
-
-
-        results = []
-
-        for row in tqdm(data, desc=filename):
-            if row["question_name"] == "Mint" or row.get("is_processed") is False:
-                results.append(row)
-                continue
-
-            signal.signal(signal.SIGALRM, _timeout_handler)
-            signal.alarm(30)
-
-            try:
-                tc = test_class_map.get((row["student_id"], row["question_name"]), None)
-                test_file = f"{row['semester']}_{row['question_name']}.py"
-                test_path = os.path.join(TEST_FILES_DIR, test_file)
-
-                if "_1_" in filename or "_3_" in filename:
-                    for side in ["synthetic", "gt"]:
-                        key = f"{side}_code_block"
-                        code = row.get(key, "").strip()
-                        if code == "" or code.upper() == "NONE":
-                            row[f"{key}_features"] = None
-                            row[f"{key}_autograder"] = None
-                        else:
-                            row[f"{key}_features"] = extract_features(code)
-                            row[f"{key}_autograder"] = Autograder.grade_submission(code, test_path)
-
-                elif "_2_" in filename:
-                    for i in range(3):
-                        for side in ["synthetic", "gt"]:
-                            key = f"{side}_code_block_q{i}"
-                            code = row.get(key, "").strip()
-                            if code == "" or code.upper() == "NONE":
-                                row[f"{key}_features"] = None
-                                row[f"{key}_autograder"] = None
-                            else:
-                                row[f"{key}_features"] = extract_features(code)
-                                row[f"{key}_autograder"] = Autograder.grade_submission(code, test_path)
-
-                new_row = {"test_class": tc}
-                for k, v in row.items():
-                    new_row[k] = v
-                results.append(new_row)
-
-
-            except TimeoutError:
-                if "_2_" in filename:
-                    for i in range(3):
-                        for side in ["gt", "synthetic"]:
-                            key = f"{side}_code_block_q{i}"
-                            row[f"{key}_features"] = None
-                            row[f"{key}_autograder"] = None
-                else:
-                    for side in ["gt", "synthetic"]:
-                        key = f"{side}_code_block"
-                        row[f"{key}_features"] = None
-                        row[f"{key}_autograder"] = None
-
-                new_row = {"test_class": tc}
-                for k, v in row.items():
-                    new_row[k] = v
-                results.append(new_row)
-
-
-            finally:
-                signal.alarm(0)
-
-
-        with open(out_path, "w") as f:
-            for row in results:
-                f.write(json.dumps(row) + "\n")
\ No newline at end of file
+if __name__ == "__main__":
+    executor = ProcessPoolExecutor(args.num_workers) if args.num_workers > 1 else None
+    try:
+        for filename in os.listdir(INPUT_DIR):
+            process_file(filename, executor)
+    finally:
+        if executor:
+            executor.shutdown()
@@ -1,4 +1,5 @@
 import os
+import ast
 import json
 import types
 import pandas as pd
@@ -6,9 +7,14 @@ from tqdm import tqdm
 from typing import Dict, Optional, Tuple, Any
 import io
 import sys
+import time
 import doctest
 from doctest import DocTestParser
 import traceback
+import signal
+import hashlib
+import sqlite3
+import tempfile
 import multiprocessing
 from concurrent.futures import ProcessPoolExecutor
 
@@ -39,7 +45,70 @@ def load_and_flatten_all_jsons(input_dir: str) -> pd.DataFrame:
     return pd.DataFrame(all_rows)
 
 
+def canonicalize_code(code_str: str) -> Optional[str]:
+    """
+    Canonical form of a submission: the dump of its AST, which ignores comments
+    and formatting. Submissions with the same canonical form behave the same
+    under the autograder (up to line numbers in tracebacks). Names are kept
+    as-is since tests and error messages depend on them.
+    
+    Args:
+        code_str: String containing the code
+        
+    Returns:
+        Canonical form, or None if the code cannot be parsed
+    """
+    try:
+        return ast.dump(ast.parse(code_str.strip()))
+    except Exception:
+        return None
+
+
+class TestTemplate:
+    """
+    Precompiled test file shared by all submissions graded against it: the
+    compiled skeleton (helpers + stub), the parsed doctest examples and the
+    compiled `print(...)` wrapper of every example.
+    """
+
+    def __init__(self, test_file: str):
+        """
+        Read, compile and parse a test file.
+        Args:
+            test_file: Path to the test file containing doctests
+        """
+        self.test_file = test_file
+        with open(test_file, 'r') as f:
+            self.test_src = f.read()
+        self.skeleton_code = compile(self.test_src, "<string>", "exec")
+
+        # parse only the >>> examples from the original source
+        parser = DocTestParser()
+        test   = parser.get_doctest(
+            self.test_src,
+            globs={},
+            name=test_file,
+            filename=test_file,
+            lineno=0
+        )
+        self.examples = test.examples
+        self.compile_flags = getattr(test, 'compile_flags', 0)
+        self.option_flags = getattr(test, 'optionflags', 0)
+
+        # examples that are not valid expressions fail again at execution time
+        self.wrapped_codes = []
+        for example in self.examples:
+            try:
+                code = compile(f"print({example.source.strip()})", "<doctest>", "exec")
+            except Exception:
+                code = None
+            self.wrapped_codes.append(code)
+
+
 class Autograder:
+
+    # per-process cache of precompiled test files, keyed by path
+    _test_templates: Dict[str, TestTemplate] = {}
     
     def __init__(self, 
                  submissions: pd.DataFrame, 
@@ -98,7 +167,8 @@ class Autograder:
                           example: doctest.Example,
                           test_globals: Dict[str, Any],
                           compile_flags: int,
-                          option_flags: int) -> Tuple[bool, str, Optional[str]]:
+                          option_flags: int,
+                          wrapped_code: Optional[types.CodeType] = None) -> Tuple[bool, str, Optional[str]]:
         """
         Execute a single doctest example in an isolated environment.
         
@@ -107,6 +177,7 @@ class Autograder:
             test_globals: Global variables for the test environment
             compile_flags: Flags for code compilation
             option_flags: Doctest option flags
+            wrapped_code: Precompiled `print(...)` wrapper of the example (if any)
             
         Returns:
             Tuple containing:
@@ -122,9 +193,11 @@ class Autograder:
         sys.displayhook = cls._create_display_hook(output_buffer, test_globals)
         
         try:
-            expr = example.source.strip()
-            wrapped = f"print({expr})"
-            code = compile(wrapped, "<doctest>", "exec")
+            code = wrapped_code
+            if code is None:
+                expr = example.source.strip()
+                wrapped = f"print({expr})"
+                code = compile(wrapped, "<doctest>", "exec")
             exec(code, test_globals)
         except Exception as e:
             error_message = f"{type(e).__name__}: {str(e)}"
@@ -141,119 +214,210 @@ class Autograder:
 
 
     @classmethod
-    def execute_test_with_timeout(cls,
-                                example: doctest.Example,
-                                test_globals: Dict[str, Any],
-                                compile_flags: int,
-                                option_flags: int,
-                                timeout: int = 2) -> Tuple[bool, str, str]:
-        """
-        Execute a doctest example with timeout protection.
+    def load_test_template(cls, test_file: str) -> "TestTemplate":
+        """
+        Load the precompiled template of a test file, compiling it on first use.
         
         Args:
-            example: Doctest example to execute
-            test_globals: Global variables for test environment
-            compile_flags: Flags for code compilation
-            option_flags: Doctest option flags
-            timeout: Maximum execution time in seconds
+            test_file: Path to the test file containing doctests
             
         Returns:
-            Tuple containing test results and any error messages
+            Cached TestTemplate for the test file
         """
-        queue = multiprocessing.Queue()
-        
-        def _execute_test_in_process():
-            result = cls.execute_single_test(example, test_globals, compile_flags, option_flags)
-            queue.put(result)
+        template = cls._test_templates.get(test_file)
+        if template is None:
+            template = TestTemplate(test_file)
+            cls._test_templates[test_file] = template
+        return template
+
+    @staticmethod
+    def _build_test_globals(compiled_code: types.CodeType, template: "TestTemplate") -> Dict[str, Any]:
+        """
+        Build the test namespace of a submission: submission, then the full
+        test file (helpers + stub), then the submission again to override the
+        stub.
         
-        process = multiprocessing.Process(target=_execute_test_in_process)
-        process.start()
-        process.join(timeout)
+        Args:
+            compiled_code: Compiled submission code
+            template: Precompiled test file
+            
+        Returns:
+            Globals dictionary of the test module
+        """
+        test_module = types.ModuleType("submission_module")
+        exec(compiled_code, test_module.__dict__)
+        exec(template.skeleton_code, test_module.__dict__)
+        exec(compiled_code, test_module.__dict__)
+        return test_module.__dict__
+
+    @staticmethod
+    def _call_with_alarm(seconds: float, func, *args) -> Any:
+        """
+        Call `func(*args)` in the sandbox worker, interrupting it with
+        _AlarmTimeout once `seconds` have passed.
         
-        if process.is_alive():
-            process.terminate()
-            process.join()
-            return False, "", "TimeoutError: infinite loop / recursion detected"
+        Args:
+            seconds: Maximum execution time in seconds
+            func: Function to call
+            *args: Arguments of the function
+            
+        Returns:
+            The return value of the function
             
-        return queue.get() if not queue.empty() else (False, "", "Error: No result returned from process")
+        Raises:
+            _AlarmTimeout: If the call runs out of time
+        """
+        _arm_alarm(seconds)
+        try:
+            return func(*args)
+        finally:
+            _disarm_alarm()
+
+    @classmethod
+    def _run_job(cls,
+                 conn,
+                 code_str: str,
+                 test_file: str,
+                 start: int,
+                 timeout: float,
+                 setup_timeout: float) -> None:
+        """
+        Run all doctest examples of a test file against a submission inside a
+        sandbox worker, sending one message per stage back to the parent.
+        
+        The first message is either ("error", error_type) or ("ok", examples),
+        followed by one (passed, output, error) tuple per example starting at
+        index `start`. Examples run one after another in the worker, each in a
+        fresh test namespace re-created from the cached test template (the
+        first one uses the namespace built while loading), so examples stay
+        isolated from each other. Building a namespace is limited to
+        `setup_timeout` and running an example to `timeout`. After a timeout
+        the job stops, and the parent recycles the worker.
+        
+        Args:
+            conn: Worker end of the pipe to the parent
+            code_str: String containing the code to test
+            test_file: Path to the test file containing doctests
+            start: Index of the first example to run
+            timeout: Maximum execution time per example in seconds
+            setup_timeout: Maximum time for building a test namespace in seconds
+        """
+        compiled_code = compile(code_str, "<string>", "exec")
+        try:
+            template = cls.load_test_template(test_file)
+        except Exception as e:
+            conn.send(("error", f"Test File Loading Error ({type(e).__name__}: {str(e)})"))
+            return
+        try:
+            test_globals = cls._call_with_alarm(setup_timeout, cls._build_test_globals, compiled_code, template)
+        except _AlarmTimeout:
+            _disarm_alarm()
+            conn.send(("error", f"Execution Error ({TIMEOUT_ERROR})"))
+            return
+        except Exception as e:
+            conn.send(("error", f"Execution Error ({type(e).__name__}: {str(e)})"))
+            return
+
+        conn.send(("ok", [(example.source, example.want) for example in template.examples]))
+
+        for i in range(start, len(template.examples)):
+            try:
+                if test_globals is None:
+                    test_globals = cls._call_with_alarm(setup_timeout, cls._build_test_globals, compiled_code, template)
+                outcome = cls._call_with_alarm(
+                    timeout,
+                    cls.execute_single_test,
+                    template.examples[i],
+                    test_globals,
+                    template.compile_flags,
+                    template.option_flags,
+                    template.wrapped_codes[i]
+                )
+            except _AlarmTimeout:
+                _disarm_alarm()
+                conn.send((False, "", TIMEOUT_ERROR))
+                return
+            except Exception as e:
+                outcome = (False, "", f"{type(e).__name__}: {str(e)}")
+            test_globals = None
+            conn.send(outcome)
+
+    @classmethod
+    def _sandbox_main(cls, conn) -> None:
+        """Main loop of a sandbox worker: serve jobs until the pipe is closed."""
+        # own process group, so that recycling the worker also kills processes started by submissions
+        os.setpgrp()
+        signal.signal(signal.SIGALRM, _on_alarm)
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
+                break
+            if job is None:
+                break
+            cls._run_job(conn, *job)
 
     @classmethod
     def grade_submission(cls,
                         code_str: str,
                         test_file: str,
-                        timeout: int = 2) -> Dict[str, Any]:
+                        timeout: int = 2,
+                        sandbox: Optional["SandboxWorker"] = None,
+                        budget: Optional[float] = None,
+                        setup_timeout: float = 30) -> Dict[str, Any]:
         """
         Grade a code submission by running tests from a separate test file.
         
+        The examples run one after another in a long-lived sandbox worker
+        process, each in a fresh test namespace. Building the namespace (the
+        submission's top-level code and the test file) has its own time limit,
+        and only the example itself counts against the per-example timeout.
+        
         Args:
             code_str: String containing the code to test
             test_file: Path to the test file containing doctests
             timeout: Maximum execution time per test in seconds
+            sandbox: Sandbox worker to run the tests in (default: the
+                process-wide worker)
+            budget: Maximum total grading time for the submission in seconds
+                (default: no limit)
+            setup_timeout: Maximum time for loading the submission and the test
+                file in seconds
             
         Returns:
             Dictionary containing grading results and test case details
+            
+        Raises:
+            GradingTimeout: If grading exceeds the budget
         """
         # Compilation check for submission
         try:
-            compiled_code = compile(code_str, "<string>", "exec")
+            compile(code_str, "<string>", "exec")
         except Exception as e:
             return {
                 "error_type": f"Compilation Error ({type(e).__name__}: {str(e)})",
                 "test_cases": None
             }
-            
-        # Create test module with submission and extra globals
-        test_module = types.ModuleType("submission_module")
-            
-        # Execute submission code
-        try:
-            exec(compiled_code, test_module.__dict__)
-        except Exception as e:
-             return {
-                 "error_type": f"Execution Error ({type(e).__name__}: {str(e)})",
-                 "test_cases": None
-             }
-        # Load & exec the full test file (helpers + stub), then override stub
-        try:
-            test_src = open(test_file, 'r').read()
-        except Exception as e:
+
+        if sandbox is None:
+            sandbox = get_sandbox()
+
+        setup, outcomes = sandbox.run(code_str, test_file, timeout, budget, setup_timeout)
+        if setup[0] == "error":
             return {
-                "error_type": f"Test File Loading Error ({type(e).__name__}: {str(e)})",
+                "error_type": setup[1],
                 "test_cases": None
             }
 
-        # bring in helpers (imports, lambdas, fixed code) and the stub
-        exec(test_src, test_module.__dict__)
-        # now override the stub with the student’s submission
-        exec(compiled_code, test_module.__dict__)
-
-        # parse only the >>> examples from the original source
-        parser = DocTestParser()
-        test   = parser.get_doctest(
-            test_src,
-            globs=test_module.__dict__,
-            name=test_file,
-            filename=test_file,
-            lineno=0
-        )
-
-
         test_results = []
         overall_error = None
 
-        for example in test.examples:
-            passed, output, error = cls.execute_test_with_timeout(
-                example,
-                test.globs,
-                getattr(test, 'compile_flags', 0),
-                getattr(test, 'optionflags', 0),
-                timeout
-            )
+        for (source, want), (passed, output, error) in zip(setup[1], outcomes):
             if error:
                 overall_error = f"Runtime Error ({error})"
-            exp = example.want.replace('"""', '').strip()
+            exp = want.replace('"""', '').strip()
             test_results.append({
-                    "test_case":     example.source.strip(),
+                    "test_case":     source.strip(),
                     "expected":      exp,
                     "got":           output.strip(),
                     "passed":        passed,
@@ -276,8 +440,44 @@ class Autograder:
 
 
 
+    @classmethod
+    def grade_submission_cached(cls,
+                                code_str: str,
+                                test_file: str,
+                                cache: "GradingCache",
+                                timeout: int = 2,
+                                rerun: bool = False,
+                                budget: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Grade a code submission, reusing the result from the grading cache if
+        the same code was already graded against the same test file.
+        
+        Args:
+            code_str: String containing the code to test
+            test_file: Path to the test file containing doctests
+            cache: Persistent grading cache
+            timeout: Maximum execution time per test in seconds
+            rerun: Whether to ignore cached results and re-grade
+            budget: Maximum total grading time for the submission in seconds
+                (default: no limit)
+            
+        Returns:
+            Dictionary containing grading results and test case details
+            
+        Raises:
+            GradingTimeout: If grading exceeds the budget (nothing is cached)
+        """
+        if not rerun:
+            test_results = cache.get(code_str, test_file, timeout)
+            if test_results is not None:
+                return test_results
+
+        test_results = cls.grade_submission(code_str, test_file, timeout=timeout, budget=budget)
+        cache.put(code_str, test_file, timeout, test_results)
+        return test_results
+
     @staticmethod
-    def _process_submission(args: Tuple[int, str, str, int, Dict[str, Any], Dict[str, Any], bool]) -> Tuple[int, Dict[str, Any]]:
+    def _process_submission(args: Tuple[int, str, str, int, str, bool, Dict[str, Any], bool]) -> Tuple[int, Dict[str, Any]]:
         """
         Static method to process a single submission, suitable for multiprocessing.
         
@@ -287,40 +487,45 @@ class Autograder:
                 - code: Code string to grade
                 - test_file: Path to the test file for the question
                 - timeout: Maximum execution time
-                - shared_memory: Shared memory for caching
+                - cache_path: Path to the grading cache database
+                - canonicalize: Whether the cache is keyed by canonical code
                 - test_results: Existing test results (if any)
                 - rerun: Whether to re-run the tests if there are existing results
                 
         Returns:
             Tuple of (submission index, test results)
         """
-        submission_idx, code, test_file, timeout, shared_memory, existing_test_results, rerun = args
-        
-        # Check cache first
-        if code.strip() in shared_memory:
-            return submission_idx, shared_memory[code.strip()]
-        
+        submission_idx, code, test_file, timeout, cache_path, canonicalize, existing_test_results, rerun = args
         # Skip if test results already exist
         if existing_test_results and not rerun:
             return submission_idx, existing_test_results
         
-        # Grade the submission using the static method
-        test_results = Autograder.grade_submission(
+        # Grade the submission, consulting the shared cache first
+        test_results = Autograder.grade_submission_cached(
             code,
             test_file,
-            timeout=timeout
+            get_grading_cache(cache_path, canonicalize),
+            timeout=timeout,
+            rerun=rerun
         )
-        
-        shared_memory[code.strip()] = test_results
         return submission_idx, test_results
 
-    def grade_submissions(self, timeout: int = 2, rerun: bool = False) -> None:
+    def grade_submissions(self,
+                          timeout: int = 2,
+                          rerun: bool = False,
+                          cache_path: Optional[str] = None,
+                          dedup: bool = False) -> None:
         """
         Grade all submissions in parallel using a process pool.
         
         Args:
             timeout: Maximum execution time per test in seconds (default: 2)
             rerun: Whether to re-run all submissions (default: False)
+            cache_path: Path to a persistent grading cache shared across runs
+                (default: a temporary cache for this run only)
+            dedup: Whether to grade only one submission per canonical form
+                (see canonicalize_code) and test file, sharing its results
+                with the rest of the group (default: False)
         
         Raises:
             RuntimeError: If there's an error during the grading process
@@ -329,32 +534,393 @@ class Autograder:
             self.graded_submissions = self.submissions.copy()
             self.graded_submissions["test_results"] = None            
             
+        temp_dir = None
+        if cache_path is None:
+            temp_dir = tempfile.TemporaryDirectory()
+            cache_path = os.path.join(temp_dir.name, "grading_cache.sqlite")
+
         try:
-            # shared memory for caching
-            manager = multiprocessing.Manager()
-            shared_memory = manager.dict()
-            
-            submission_data = [
-                (idx, 
-                 row[self.code_col_name], 
-                 os.path.join(self.test_files_dir, f"{row['question']}.py"),
-                 timeout,
-                 shared_memory,
-                 row["test_results"],
-                 rerun)
-                for idx, row in self.graded_submissions.iterrows()
-            ]
+            # compile test files once so that forked workers inherit the templates
+            for question in self.graded_submissions["question"].unique():
+                try:
+                    self.load_test_template(os.path.join(self.test_files_dir, f"{question}.py"))
+                except Exception:
+                    pass
+
+            # group submissions that must behave the same, keyed by representative
+            groups = {}
+            submission_data = []
+            for position, (idx, row) in enumerate(self.graded_submissions.iterrows()):
+                code = row[self.code_col_name]
+                test_file = os.path.join(self.test_files_dir, f"{row['question']}.py")
+                group_key = position
+                if dedup:
+                    canonical = canonicalize_code(code)
+                    group_key = ("ast", canonical, test_file) if canonical is not None else ("text", code.strip(), test_file)
+                if group_key in groups:
+                    groups[group_key].append(idx)
+                    continue
+                groups[group_key] = [idx]
+                submission_data.append(
+                    (idx,
+                     code,
+                     test_file,
+                     timeout,
+                     cache_path,
+                     dedup,
+                     row["test_results"],
+                     rerun)
+                )
+            members = {group[0]: group for group in groups.values()}
             
-            # parallel processing
-            with ProcessPoolExecutor() as executor:
+            # parallel processing, each worker grading in its own pre-warmed sandbox
+            with ProcessPoolExecutor(initializer=get_sandbox) as executor:
                 results = list(tqdm(
                     executor.map(self._process_submission, submission_data),
-                    total=len(self.submissions),
+                    total=len(submission_data),
                     desc="Grading submissions"
                 ))
             
+            # fan the results of each representative out to its group
+            results = [(idx, result) for rep_idx, result in results for idx in members[rep_idx]]
             indices, test_results = zip(*results)
             self.graded_submissions.loc[list(indices), "test_results"] = list(test_results)
             
         except Exception as e:
             raise RuntimeError(f"Error during bulk grading: {str(e)}") from e
+        finally:
+            if temp_dir is not None:
+                temp_dir.cleanup()
+
+
+class GradingTimeout(TimeoutError):
+    """Raised when grading a submission exceeds its total time budget."""
+
+
+_TIMED_OUT = object()
+_CRASHED = object()
+TIMEOUT_ERROR = "TimeoutError: infinite loop / recursion detected"
+NO_RESULT_ERROR = "Error: No result returned from process"
+
+
+class _AlarmTimeout(BaseException):
+    """Raised by SIGALRM in the sandbox worker; not an Exception, so submissions rarely catch it."""
+
+
+# whether SIGALRM should interrupt the code running in the sandbox worker
+_alarm_armed = False
+
+
+def _on_alarm(signum, frame) -> None:
+    if _alarm_armed:
+        raise _AlarmTimeout()
+
+
+def _arm_alarm(seconds: float) -> None:
+    """Interrupt the sandbox worker after `seconds`, and again every 0.1 s
+    in case the code swallows the first interruption."""
+    global _alarm_armed
+    _alarm_armed = True
+    signal.setitimer(signal.ITIMER_REAL, seconds, 0.1)
+
+
+def _disarm_alarm() -> None:
+    global _alarm_armed
+    _alarm_armed = False
+    signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def is_transient_result(result: Dict[str, Any]) -> bool:
+    """
+    Whether a grading result contains a timeout or a crash, which may be
+    caused by machine load rather than by the submission.
+    
+    Args:
+        result: Grading result
+        
+    Returns:
+        True if loading or any test case timed out or returned no result
+    """
+    errors = [result.get("error_type") or ""]
+    errors += [test_case.get("error_message") or "" for test_case in result.get("test_cases") or []]
+    return any(TIMEOUT_ERROR in error or NO_RESULT_ERROR in error for error in errors)
+
+
+class SandboxWorker:
+    """
+    Long-lived sandbox process that runs grading jobs for one submission at a
+    time. The worker runs the examples itself and interrupts them with
+    SIGALRM when they time out. It is only recycled after a timeout, a crash
+    or when it stops responding; examples after the failing one are resumed
+    in a new worker.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.conn = None
+        self.owner_pid = os.getpid()
+        self.start()
+
+    def start(self) -> None:
+        """Start the sandbox process."""
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=Autograder._sandbox_main,
+            args=(child_conn,),
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+
+    def close(self) -> None:
+        """Terminate the sandbox process."""
+        if self.process is None:
+            return
+        # the worker leads its own process group, which includes processes started by submissions
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        self.process.join()
+        self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def restart(self) -> None:
+        """Replace the sandbox process with a fresh one."""
+        self.close()
+        self.start()
+
+    def _recv(self, timeout: float, deadline: Optional[float] = None) -> Any:
+        """
+        Wait for the next message from the sandbox, recycling the process if
+        none arrives within the timeout or the process dies.
+        
+        Args:
+            timeout: Maximum waiting time in seconds
+            deadline: Monotonic time at which the job's budget runs out (if any)
+            
+        Returns:
+            The received message, or the _TIMED_OUT / _CRASHED sentinel
+            
+        Raises:
+            GradingTimeout: If the deadline passes before a message arrives
+        """
+        wait = timeout
+        if deadline is not None:
+            wait = min(timeout, max(0.0, deadline - time.monotonic()))
+        if not self.conn.poll(wait):
+            self.restart()
+            if wait < timeout:
+                raise GradingTimeout("grading budget exceeded")
+            return _TIMED_OUT
+        try:
+            return self.conn.recv()
+        except EOFError:
+            self.restart()
+            return _CRASHED
+
+    def run(self,
+            code_str: str,
+            test_file: str,
+            timeout: int = 2,
+            budget: Optional[float] = None,
+            setup_timeout: float = 30) -> Tuple[Tuple[str, Any], list]:
+        """
+        Run all doctest examples for a submission, each with its own timeout.
+        
+        Args:
+            code_str: String containing the code to test
+            test_file: Path to the test file containing doctests
+            timeout: Maximum execution time per test in seconds
+            budget: Maximum total time for the submission in seconds
+                (default: no limit)
+            setup_timeout: Maximum time for loading the submission and the
+                test file in seconds
+            
+        Returns:
+            Tuple containing:
+            - Setup message, ("error", error_type) or ("ok", [(source, want), ...])
+            - List of (passed, output, error) tuples, one per example
+            
+        Raises:
+            GradingTimeout: If the budget runs out; the worker is recycled
+        """
+        deadline = time.monotonic() + budget if budget is not None else None
+        try:
+            return self._run(code_str, test_file, timeout, deadline, setup_timeout)
+        except GradingTimeout:
+            raise
+        except BaseException:
+            # an interrupted job may leave messages behind in the pipe
+            self.restart()
+            raise
+
+    def _run(self,
+             code_str: str,
+             test_file: str,
+             timeout: int,
+             deadline: Optional[float],
+             setup_timeout: float) -> Tuple[Tuple[str, Any], list]:
+        """Drive one job through the sandbox, resuming after timeouts and crashes."""
+        outcomes = []
+        while True:
+            if not self.process.is_alive():
+                self.restart()
+            start = len(outcomes)
+            self.conn.send((code_str, test_file, start, timeout, setup_timeout))
+
+            # the worker enforces the time limits; these waits only catch a stuck worker
+            setup = self._recv(setup_timeout + 1, deadline)
+            if setup is _TIMED_OUT:
+                return ("error", f"Execution Error ({TIMEOUT_ERROR})"), []
+            if setup is _CRASHED:
+                return ("error", f"Execution Error ({NO_RESULT_ERROR})"), []
+            if setup[0] == "error":
+                return setup, []
+
+            num_examples = len(setup[1])
+            while len(outcomes) < num_examples:
+                # examples after the first also re-create the test namespace
+                wait = timeout + 1 if len(outcomes) == start else setup_timeout + timeout + 1
+                outcome = self._recv(wait, deadline)
+                if outcome is _TIMED_OUT:
+                    outcomes.append((False, "", TIMEOUT_ERROR))
+                    break
+                if outcome is _CRASHED:
+                    outcomes.append((False, "", NO_RESULT_ERROR))
+                    break
+                outcomes.append(outcome)
+                if outcome[2] == TIMEOUT_ERROR:
+                    # the interrupted example may have left the worker in a bad state
+                    self.restart()
+                    break
+
+            if len(outcomes) == num_examples:
+                return setup, outcomes
+
+
+_sandbox: Optional[SandboxWorker] = None
+
+
+def get_sandbox() -> SandboxWorker:
+    """Return the sandbox worker of the current process, starting it on first use."""
+    global _sandbox
+    if _sandbox is None or _sandbox.owner_pid != os.getpid():
+        _sandbox = SandboxWorker()
+    return _sandbox
+
+
+class GradingCache:
+    """
+    Persistent, content-addressed store of grading results shared across runs,
+    models and processes. Results are keyed by a hash of the normalized
+    (stripped) code, a hash of the test file contents and the timeout.
+    Results with timeouts or crashes (see is_transient_result) are only kept
+    in memory for the current process, so they are re-graded by later runs.
+    """
+
+    def __init__(self, path: str, canonicalize: bool = False):
+        """
+        Open (or create) the cache database.
+        Args:
+            path: Path to the SQLite database file
+            canonicalize: Whether to normalize code to its canonical form (see
+                canonicalize_code), so that submissions differing only in
+                comments or formatting share a result
+        """
+        self.path = path
+        self.canonicalize = canonicalize
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "code_hash TEXT, test_hash TEXT, timeout REAL, result TEXT, "
+            "PRIMARY KEY (code_hash, test_hash, timeout))"
+        )
+        self.conn.commit()
+        self._test_hashes: Dict[str, str] = {}
+        self._transient: Dict[Tuple[str, str, float], Dict[str, Any]] = {}
+
+    def hash_code(self, code_str: str) -> str:
+        """Hash of the normalized code."""
+        key = code_str.strip()
+        if self.canonicalize:
+            canonical = canonicalize_code(code_str)
+            if canonical is not None:
+                key = f"ast:{canonical}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def hash_test_file(self, test_file: str) -> str:
+        """Hash of the test file contents, computed once per path."""
+        test_hash = self._test_hashes.get(test_file)
+        if test_hash is None:
+            try:
+                with open(test_file, "rb") as f:
+                    test_hash = hashlib.sha256(f.read()).hexdigest()
+            except OSError:
+                test_hash = f"missing:{test_file}"
+            self._test_hashes[test_file] = test_hash
+        return test_hash
+
+    def get(self, code_str: str, test_file: str, timeout: int = 2) -> Optional[Dict[str, Any]]:
+        """
+        Look up a grading result.
+        
+        Args:
+            code_str: String containing the code
+            test_file: Path to the test file
+            timeout: Timeout the result was graded with
+            
+        Returns:
+            Cached grading result, or None if missing
+        """
+        key = (self.hash_code(code_str), self.hash_test_file(test_file), timeout)
+        if key in self._transient:
+            return self._transient[key]
+        row = self.conn.execute(
+            "SELECT result FROM results WHERE code_hash = ? AND test_hash = ? AND timeout = ?",
+            key
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, code_str: str, test_file: str, timeout: int, result: Dict[str, Any]) -> None:
+        """
+        Store a grading result; results with timeouts or crashes are only
+        kept in memory.
+        
+        Args:
+            code_str: String containing the code
+            test_file: Path to the test file
+            timeout: Timeout the result was graded with
+            result: Grading result
+        """
+        key = (self.hash_code(code_str), self.hash_test_file(test_file), timeout)
+        if is_transient_result(result):
+            self._transient[key] = result
+            return
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                key + (json.dumps(result),)
+            )
+
+    def close(self) -> None:
+        """Close the database connection."""
+        self.conn.close()
+
+
+_grading_caches: Dict[Tuple[int, str, bool], GradingCache] = {}
+
+
+def get_grading_cache(path: str, canonicalize: bool = False) -> GradingCache:
+    """Return the connection to a grading cache owned by the current process."""
+    key = (os.getpid(), path, canonicalize)
+    if key not in _grading_caches:
+        _grading_caches[key] = GradingCache(path, canonicalize)
+    return _grading_caches[key]
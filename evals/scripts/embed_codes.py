@@ -2,19 +2,29 @@ import os
 import re
 import glob
 import json
+import hashlib
 from tqdm import tqdm
 
+import numpy as np
 import torch
 from sentence_transformers import SentenceTransformer
 
 INPUT_DIR = "../data/formatted/"
 OUTPUT_DIR = "../data/formatted_embeddings/"
+CACHE_DIR = "../data/embedding_cache/"
 MODELS = ["gpt_4_1", "llama_3_8b", "qwen_2_5_coder_3b", "qwen_2_5_coder_7b", "qwen_2_5_coder_7b_inst", "qwen_3_8b"]
 EMBEDDING_MODEL_NAME = "Salesforce/SFR-Embedding-Code-400M_R"
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 EMBEDDING_MODEL = SentenceTransformer(EMBEDDING_MODEL_NAME, trust_remote_code=True, device=device)
 
+# code fields embedded per experiment type
+CODE_FIELDS = {
+    "1": ["gt_code_block", "synthetic_code_block"],
+    "2": [f"{kind}_code_block_q{i}" for kind in ["gt", "synthetic"] for i in range(3)],
+    "3": ["gt_code_block", "synthetic_code_block"],
+}
+
 ########################################################
 # Utils
 ########################################################
@@ -42,51 +52,89 @@ def save_data(data, file_path):
         for item in data:
             f.write(json.dumps(item) + "\n")
 
-def embed_codes(codes: list[str]):
-    return EMBEDDING_MODEL.encode(codes)
-
-def embed_data(input_data: dict, batch_size: int = 72):
-    data = input_data["data"]
-    if input_data["exp_type"] == "1" or input_data["exp_type"] == "3":
-        exp_batch_size = max(1, batch_size//2)
-        for i in tqdm(range(0, len(data), exp_batch_size)):
-            batch_data = data[i:i+exp_batch_size]
-            gt_codes = [item.get("gt_code_block", "") for item in batch_data]
-            synthetic_codes = [item.get("synthetic_code_block", "") for item in batch_data]
-            codes = gt_codes + synthetic_codes
-            embeddings = embed_codes(codes)
-            assert len(embeddings) == len(codes)
-            for j, item in enumerate(batch_data):
-                if item["is_processed"]:
-                    item["embeddings"] = {}
-                    item["embeddings"]["gt_code_block"] = embeddings[j].tolist()
-                    item["embeddings"]["synthetic_code_block"] = embeddings[j+len(batch_data)].tolist()
-    
-    elif input_data["exp_type"] == "2":
-        exp_batch_size = max(1, batch_size//6)
-        for i in tqdm(range(0, len(data), exp_batch_size)):
-            batch_data = data[i:i+exp_batch_size]
-            gt_codes_q0 = [item.get("gt_code_block_q0", "") for item in batch_data]
-            gt_codes_q1 = [item.get("gt_code_block_q1", "") for item in batch_data]
-            gt_codes_q2 = [item.get("gt_code_block_q2", "") for item in batch_data]
-            synthetic_codes_q0 = [item.get("synthetic_code_block_q0", "") for item in batch_data]
-            synthetic_codes_q1 = [item.get("synthetic_code_block_q1", "") for item in batch_data]
-            synthetic_codes_q2 = [item.get("synthetic_code_block_q2", "") for item in batch_data]
-            codes = gt_codes_q0 + gt_codes_q1 + gt_codes_q2 + synthetic_codes_q0 + synthetic_codes_q1 + synthetic_codes_q2
-            embeddings = embed_codes(codes)
-            assert len(embeddings) == len(codes)
-            for j, item in enumerate(batch_data):
-                if item["is_processed"]:
-                    item["embeddings"] = {}
-                    item["embeddings"]["gt_code_block_q0"] = embeddings[j].tolist()
-                    item["embeddings"]["gt_code_block_q1"] = embeddings[j+len(batch_data)].tolist()
-                    item["embeddings"]["gt_code_block_q2"] = embeddings[j+2*len(batch_data)].tolist()
-                    item["embeddings"]["synthetic_code_block_q0"] = embeddings[j+3*len(batch_data)].tolist()
-                    item["embeddings"]["synthetic_code_block_q1"] = embeddings[j+4*len(batch_data)].tolist()
-                    item["embeddings"]["synthetic_code_block_q2"] = embeddings[j+5*len(batch_data)].tolist()
+class EmbeddingStore:
+    """
+    Persistent embeddings keyed by a hash of the embedding model name and the
+    code. Embeddings are appended as float16 rows to `embeddings.f16` (read
+    back through a memory map) and `index.jsonl` maps each key to its row, so
+    every unique snippet is encoded once across models, files and runs.
+    """
+
+    def __init__(self, cache_dir, model_name, dim):
+        self.model_name = model_name
+        self.dim = dim
+        store_dir = os.path.join(cache_dir, model_name.replace("/", "__"))
+        os.makedirs(store_dir, exist_ok=True)
+        self.matrix_path = os.path.join(store_dir, "embeddings.f16")
+        self.index_path = os.path.join(store_dir, "index.jsonl")
+        row_bytes = dim * np.dtype(np.float16).itemsize
+
+        # drop a partially written row left by an interrupted run
+        self.num_rows = os.path.getsize(self.matrix_path) // row_bytes if os.path.exists(self.matrix_path) else 0
+        if os.path.exists(self.matrix_path):
+            os.truncate(self.matrix_path, self.num_rows * row_bytes)
+        self.rows = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb+") as f:
+                index = f.read()
+                # drop a partially written last line so later entries start on a new line
+                f.truncate(index.rfind(b"\n") + 1)
+            for line in index.splitlines(keepends=True):
+                if not line.endswith(b"\n"):
+                    continue
+                entry = json.loads(line)
+                if entry["row"] < self.num_rows:
+                    self.rows[entry["key"]] = entry["row"]
+        self.matrix = None
+
+    def key(self, code):
+        return hashlib.sha256(f"{self.model_name}\0{code}".encode()).hexdigest()
+
+    def __contains__(self, code):
+        return self.key(code) in self.rows
+
+    def add(self, codes, embeddings):
+        # rows are written before the index entries that point to them
+        with open(self.matrix_path, "ab") as f:
+            f.write(np.asarray(embeddings, dtype=np.float16).tobytes())
+        with open(self.index_path, "a") as f:
+            for i, code in enumerate(codes):
+                key = self.key(code)
+                self.rows[key] = self.num_rows + i
+                f.write(json.dumps({"key": key, "row": self.num_rows + i}) + "\n")
+        self.num_rows += len(codes)
+        self.matrix = None
+
+    def get(self, code):
+        if self.matrix is None:
+            self.matrix = np.memmap(self.matrix_path, dtype=np.float16, mode="r", shape=(self.num_rows, self.dim))
+        return self.matrix[self.rows[self.key(code)]]
+
+def embed_codes(codes: list[str], batch_size: int = 72):
+    return EMBEDDING_MODEL.encode(codes, batch_size=batch_size)
+
+def embed_missing(codes: list[str], store: EmbeddingStore, batch_size: int = 72, chunk_size: int = 4096):
+    """Encode each code that is not in the store yet, once, and add it to the store."""
+    missing = list(dict.fromkeys(code for code in codes if code not in store))
+    print(f"{len(missing)} new code snippets to embed")
+    # store after every chunk so an interrupted run keeps its progress
+    for i in tqdm(range(0, len(missing), chunk_size)):
+        chunk = missing[i:i+chunk_size]
+        embeddings = embed_codes(chunk, batch_size)
+        assert len(embeddings) == len(chunk)
+        store.add(chunk, embeddings)
+
+def embed_data(input_data: dict, store: EmbeddingStore, batch_size: int = 72):
+    fields = CODE_FIELDS[input_data["exp_type"]]
+    # unprocessed rows get no embeddings, so their codes never reach the encoder
+    rows = [item for item in input_data["data"] if item["is_processed"]]
+    embed_missing([item.get(field, "") for item in rows for field in fields], store, batch_size)
+    for item in rows:
+        item["embeddings"] = {field: store.get(item.get(field, "")).tolist() for field in fields}
 
 def main():
     print(f"STARTING PROCESSING...\n")
+    store = EmbeddingStore(CACHE_DIR, EMBEDDING_MODEL_NAME, EMBEDDING_MODEL.get_sentence_embedding_dimension())
     for model in MODELS:
         print(f'EMBEDDING {model.upper()} OUTPUTS...\n{"#" * 50}\n')
         dir_path = os.path.join(INPUT_DIR, model)    
@@ -94,7 +142,7 @@ def main():
         model_data = [{"file_path": file, "model": model, "exp_type": get_exp_type(file), "data": load_data(file)} for file in input_files]
         for data in model_data:
             print(f'PROCESSING {data["file_path"]} (model: {data["model"]}, exp_type: {data["exp_type"]}, size: {len(data["data"])})...\n{"#" * 50}\n')
-            embed_data(data)
+            embed_data(data, store)
             save_data(data['data'], os.path.join(OUTPUT_DIR, model, os.path.basename(data["file_path"])))
             print(f'DONE EXPERIMENT! SAVED TO {os.path.join(OUTPUT_DIR, model, os.path.basename(data["file_path"]))}\n{"#" * 50}\n')
         print(f'DONE MODEL! EMBEDDED {model.upper()} OUTPUTS\n{"#" * 50}\n')
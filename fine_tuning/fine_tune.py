@@ -1,11 +1,13 @@
 import os
-import wandb
+import json
+import argparse
 from dataclasses import dataclass
+from functools import partial
 
-from datasets import load_dataset
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
+    HfArgumentParser,
     Trainer,
     TrainingArguments,
     DataCollatorForSeq2Seq,
@@ -25,6 +27,17 @@ class ScriptArguments:
     experiment_name: str = "INSERT_EXPERIMENT_NAME"
     dataset_file: str = "INSERT_PATH_TO_DATASET"
     test_size: float = 0.1
+    # use only the first N examples (e.g. for smoke tests)
+    max_train_samples: int = None
+    # no wandb and no hub: nothing needs credentials
+    offline: bool = False
+    # preprocessing
+    num_proc: int = os.cpu_count()
+    tokenized_cache_dir: str = "../data/tokenized_cache"
+    # rendered prompts are cached here and shared with data_generation (None disables)
+    prompt_cache_dir: str = "../data/prompt_cache"
+    # fit with-context prompts into this many tokens, as data_generation's context_token_budget
+    context_token_budget: int = None
     # wandb
     wandb_entity: str = "INSERT_ENTITY"
     wandb_project: str = "INSERT_PROJECT"
@@ -33,6 +46,11 @@ class ScriptArguments:
 class ModelConfig:
     model_name: str = "Qwen/Qwen2.5-Coder-7B"
     max_seq_length: int = 8192
+    attn_implementation: str = "sdpa"
+    # pack several examples into each max_seq_length row (examples never attend to each other)
+    packing: bool = False
+    # split each optimizer step into length-grouped micro-batches of at most this many padded tokens
+    max_tokens_per_batch: int = None
     # lora params
     lora_r: int = 16
     lora_alpha: int = 32
@@ -40,7 +58,7 @@ class ModelConfig:
     lora_target_modules: str = "all-linear"
     lora_bias: str = "none"
     
-training_args = TrainingArguments(
+TRAINING_DEFAULTS = dict(
     output_dir="INSERT_OUTPUT_DIR/",
     per_device_train_batch_size=4,
     per_device_eval_batch_size=4,
@@ -63,42 +81,65 @@ training_args = TrainingArguments(
     hub_strategy="all_checkpoints",
     hub_model_id="INSERT_HF_MODEL_ID",
     hub_private_repo=True,
-    hub_token=os.environ["HF_TOKEN"],
+    hub_token=os.environ.get("HF_TOKEN"),
 )
 
-def prepare_dataset(script_args: ScriptArguments):
-    dataset = load_dataset("json", data_files=script_args.dataset_file, split="train")
-    if script_args.experiment_name == "exp1_without_context":
-        dataset = dataset.map(process_input_exp1_without_context, load_from_cache_file=False)
-        dataset = dataset.map(process_output_exp1_without_context, load_from_cache_file=False)
-    elif script_args.experiment_name == "exp1_with_context":
-        dataset = dataset.map(process_input_exp1_with_context, load_from_cache_file=False)
-        dataset = dataset.map(process_output_exp1_with_context, load_from_cache_file=False)
-    elif script_args.experiment_name == "exp2_without_context":
-        dataset = dataset.map(process_input_exp2_without_context, load_from_cache_file=False)
-        dataset = dataset.map(process_output_exp2_without_context, load_from_cache_file=False)
-    elif script_args.experiment_name == "exp2_with_context":
-        dataset = dataset.map(process_input_exp1_with_context, load_from_cache_file=False)
-        dataset = dataset.map(process_output_exp1_with_context, load_from_cache_file=False)
-    else:
-        raise ValueError(f"Experiment name {script_args.experiment_name} not supported")
-    dataset = dataset.remove_columns(["INPUT", "OUTPUT"])
-    return dataset
-
-script_args = ScriptArguments()
-model_args = ModelConfig()
-
-wandb.init(
-    entity=script_args.wandb_entity,
-    project=script_args.wandb_project,
-    name=training_args.run_name,
-)
+def prepare_dataset(script_args: ScriptArguments, tokenizer):
+    packer = None
+    if script_args.context_token_budget is not None and script_args.experiment_name in PAST_PROBLEM_SUBMISSION_ENTRY_FUNCTIONS:
+        packer = ContextPacker(tokenizer, script_args.context_token_budget)
+    return load_prompt_dataset(
+        script_args.dataset_file,
+        script_args.experiment_name,
+        prompt_template="ft",
+        cache_dir=script_args.prompt_cache_dir,
+        num_proc=script_args.num_proc,
+        packer=packer,
+    )
+
+# arguments come from the defaults above, then the --config JSON file, then command-line flags
+config_parser = argparse.ArgumentParser(add_help=False)
+config_parser.add_argument("--config", type=str)
+config_args, remaining_args = config_parser.parse_known_args()
+
+parser = HfArgumentParser((ScriptArguments, ModelConfig, TrainingArguments), parents=[config_parser])
+parser.set_defaults(**TRAINING_DEFAULTS)
+if config_args.config is not None:
+    with open(config_args.config, "r") as f:
+        config_data = json.load(f)
+    known_args = {action.dest for action in parser._actions}
+    unknown_args = sorted(set(config_data) - known_args)
+    if unknown_args:
+        raise ValueError(f"Unknown arguments in {config_args.config}: {unknown_args}")
+    parser.set_defaults(**config_data)
+script_args, model_args, training_args, _ = parser.parse_args_into_dataclasses(args=remaining_args)
+
+if script_args.offline:
+    training_args.report_to = []
+    training_args.push_to_hub = False
+# count input tokens (including padding) for the throughput report
+training_args.include_num_input_tokens_seen = True
+
+if "wandb" in training_args.report_to:
+    import wandb
+    wandb.init(
+        entity=script_args.wandb_entity,
+        project=script_args.wandb_project,
+        name=training_args.run_name,
+    )
 
 ########################################################
 # dataset
 ########################################################
 
-dataset = prepare_dataset(script_args)
+tokenizer = AutoTokenizer.from_pretrained(model_args.model_name, trust_remote_code=True)
+if tokenizer.pad_token is None:
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.pad_token_id = tokenizer.eos_token_id
+
+dataset = prepare_dataset(script_args, tokenizer)
+if script_args.max_train_samples is not None:
+    dataset = dataset.select(range(min(script_args.max_train_samples, len(dataset))))
 split = dataset.train_test_split(
     shuffle=True,
     test_size=script_args.test_size,
@@ -120,55 +161,46 @@ print(f"Train dataset: {train_dataset}")
 print(f"Eval dataset: {eval_dataset}")
 print("-" * 100)
 
-tokenizer = AutoTokenizer.from_pretrained(model_args.model_name, trust_remote_code=True)
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
-    tokenizer.pad_token_id = tokenizer.eos_token_id
-
-def preprocess(example):
-    input_text, output_text = example["input"], example["output"]
-    tokenized_full = tokenizer(
-        input_text + output_text,
-        truncation=True,
-        max_length=model_args.max_seq_length,
-        return_tensors="pt",
+# tokenize the full dataset once (cached on disk) and split it the same way as the text
+tokenized_split = load_tokenized_dataset(
+    dataset,
+    tokenizer,
+    model_args.max_seq_length,
+    cache_dir=script_args.tokenized_cache_dir,
+    num_proc=script_args.num_proc,
+).train_test_split(
+    shuffle=True,
+    test_size=script_args.test_size,
+    seed=42,
+)
+train_dataset, eval_dataset = tokenized_split["train"], tokenized_split["test"]
+
+if model_args.packing and model_args.max_tokens_per_batch is not None:
+    raise ValueError("packing and max_tokens_per_batch can't be used together")
+if model_args.packing:
+    train_dataset = pack_dataset(train_dataset, model_args.max_seq_length, num_proc=script_args.num_proc)
+    eval_dataset = pack_dataset(eval_dataset, model_args.max_seq_length, num_proc=script_args.num_proc)
+    print(f"Packed into {len(train_dataset)} train / {len(eval_dataset)} eval rows")
+    data_collator = PackedDataCollator(
+        pad_token_id=tokenizer.pad_token_id,
+        attn_implementation=model_args.attn_implementation,
+        pad_to_multiple_of=8,
     )
-    input_ids_full = tokenized_full["input_ids"][0]
-    input_tokenized = tokenizer(
-        input_text,
-        truncation=True,
+else:
+    if model_args.max_tokens_per_batch is not None:
+        # each train batch is a whole optimizer step; TokenBudgetTrainer does the accumulation
+        training_args.per_device_train_batch_size *= training_args.gradient_accumulation_steps
+        training_args.gradient_accumulation_steps = 1
+        # micro-batches are trimmed from the right (see split_into_micro_batches)
+        tokenizer.padding_side = "right"
+    data_collator = DataCollatorForSeq2Seq(
+        tokenizer=tokenizer,
+        model=None,
+        padding="longest",
         max_length=model_args.max_seq_length,
-        return_tensors="pt",
+        pad_to_multiple_of=8,
+        label_pad_token_id=-100,
     )
-    split_idx = len(input_tokenized["input_ids"][0])
-    labels = [-100] * split_idx + input_ids_full[split_idx:].tolist()
-    return {
-        "input_ids": input_ids_full.tolist(),
-        "attention_mask": tokenized_full["attention_mask"][0].tolist(),
-        "labels": labels,
-    }
-
-train_dataset = train_dataset.map(
-    preprocess,
-    remove_columns=train_dataset.column_names,
-    batched=False,
-    load_from_cache_file=False,
-)
-eval_dataset = eval_dataset.map(
-    preprocess,
-    remove_columns=eval_dataset.column_names,
-    batched=False,
-    load_from_cache_file=False,
-)
-
-data_collator = DataCollatorForSeq2Seq(
-    tokenizer=tokenizer,
-    model=None,
-    padding="longest",
-    max_length=model_args.max_seq_length,
-    pad_to_multiple_of=8,
-    label_pad_token_id=-100,
-)
 
 ########################################################
 # model
@@ -176,8 +208,9 @@ data_collator = DataCollatorForSeq2Seq(
 
 model = AutoModelForCausalLM.from_pretrained(
     model_args.model_name,
-    device_map="auto",
+    device_map=None if training_args.use_cpu else "auto",
     trust_remote_code=True,
+    attn_implementation=model_args.attn_implementation,
 )
 model.config.pad_token_id = tokenizer.pad_token_id
 model.enable_input_require_grads() # https://github.com/huggingface/transformers/issues/23170
@@ -197,17 +230,23 @@ model.print_trainable_parameters()
 # training
 ########################################################
 
-trainer = Trainer(
+if model_args.max_tokens_per_batch is not None:
+    trainer_class = partial(TokenBudgetTrainer, max_tokens_per_batch=model_args.max_tokens_per_batch)
+else:
+    trainer_class = Trainer
+trainer = trainer_class(
     model=model,
     args=training_args,
     train_dataset=train_dataset,
     eval_dataset=eval_dataset,
     data_collator=data_collator,
     processing_class=tokenizer,
+    callbacks=[ThroughputCallback()],
 )
 
 trainer.train()
 
 if training_args.push_to_hub:
     trainer.push_to_hub()
-wandb.finish()
+if "wandb" in training_args.report_to:
+    wandb.finish()
@@ -1,121 +1,299 @@
-import re
-from templates import *
+import os
+import sys
+import json
+import time
+import bisect
+import hashlib
+import resource
+import statistics
 
-def process_instructions(instructions):
-    instructions = re.sub(r"\n+", "\n", instructions)
-    return instructions.strip()
+import torch
+import pyarrow.compute as pc
+from datasets import Dataset, load_from_disk
+from transformers import Trainer, TrainerCallback
+from transformers.trainer_pt_utils import LengthGroupedSampler
+
+# the prompt-rendering package (prompts/) is installed with `pip install -e .` from the
+# repository root; a checkout that hasn't been installed imports it from there
+try:
+    from prompts import *
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from prompts import *
 
 ########################################################
-# EXPERIMENT 1
+# TOKENIZATION
 ########################################################
 
-##################
-# without context
-##################
-
-def process_input_exp1_without_context(example):
-    input = example["INPUT"]
-    processed_input = EXP_1_WITHOUT_CONTEXT_INPUT_TEMPLATE.format(
-        instructions=process_instructions(input["instructions"]),
-        fixed_code=input["skeleton_code_fixed"].strip(),
-        skeleton_code=input["skeleton_code_todo"].strip(),
-        timestamp=" ".join(input["quantile"].split("_")).upper()
-    )
-    return {"input": processed_input}
-
-def process_output_exp1_without_context(example):
-    student_code = f"<code>{example['OUTPUT'].strip()}</code>"
-    return {"output": student_code}
-
-##################
-# with context
-##################
-
-def process_past_problem_submissions_exp1_with_context(example):
-    past_problem_submissions = example["past_problem_submissions"]
-    processed_past_submissions = ""
-    for submission in past_problem_submissions:
-        processed_past_submissions += (f"PROBLEM NAME: {submission['question_name']}\n"
-                                       f"<code>{submission['submission'].strip()}</code>\n\n")
-    return processed_past_submissions.strip()
-
-def process_input_exp1_with_context(example):
-    input = example["INPUT"]
-    processed_input = EXP_1_WITH_CONTEXT_INPUT_TEMPLATE.format(
-        past_problem_submissions=process_past_problem_submissions_exp1_with_context(input),
-        instructions=process_instructions(input["instructions"]),
-        fixed_code=input["skeleton_code_fixed"].strip(),
-        skeleton_code=input["skeleton_code_todo"].strip(),
-        timestamp=" ".join(input["quantile"].split("_")).upper()
+def tokenize_batch(batch, tokenizer, max_seq_length):
+    """
+    Tokenize prompts and completions separately (once each) and concatenate
+    them; prompt tokens are masked out of the labels with -100.
+    """
+    prompt_ids = tokenizer(batch["input"])["input_ids"]
+    completion_ids = tokenizer(batch["output"], add_special_tokens=False)["input_ids"]
+    input_ids, attention_mask, labels = [], [], []
+    for prompt, completion in zip(prompt_ids, completion_ids):
+        ids = (prompt + completion)[:max_seq_length]
+        input_ids.append(ids)
+        attention_mask.append([1] * len(ids))
+        labels.append(([-100] * len(prompt) + completion)[:max_seq_length])
+    return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+def tokenizer_fingerprint(tokenizer):
+    sha256 = hashlib.sha256(tokenizer.name_or_path.encode())
+    if tokenizer.is_fast:
+        sha256.update(tokenizer.backend_tokenizer.to_str().encode())
+    else:
+        sha256.update(repr(sorted(tokenizer.get_vocab().items())).encode())
+    return sha256.hexdigest()
+
+def dataset_fingerprint(dataset, columns=("input", "output")):
+    sha256 = hashlib.sha256()
+    for column in columns:
+        for text in dataset[column]:
+            sha256.update(text.encode())
+            sha256.update(b"\0")
+    return sha256.hexdigest()
+
+def load_tokenized_dataset(dataset, tokenizer, max_seq_length, cache_dir=None, num_proc=None):
+    """
+    Tokenize the prompt dataset (`input` / `output` columns) in batches. If
+    `cache_dir` is set, the result is saved there under a key made of the
+    tokenizer, max_seq_length and a hash of the prompts and completions, and
+    reused by later runs with the same key.
+    """
+    cache_path = None
+    if cache_dir is not None:
+        key = "\n".join([tokenizer_fingerprint(tokenizer), str(max_seq_length), dataset_fingerprint(dataset)])
+        cache_path = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest()[:16])
+        if os.path.exists(cache_path):
+            return load_from_disk(cache_path)
+
+    dataset = dataset.map(
+        tokenize_batch,
+        fn_kwargs={"tokenizer": tokenizer, "max_seq_length": max_seq_length},
+        batched=True,
+        remove_columns=dataset.column_names,
+        num_proc=num_proc,
+        load_from_cache_file=False,
     )
-    return {"input": processed_input}
+    if cache_path is not None:
+        # save under a temporary name so an interrupted save is never loaded
+        tmp_path = f"{cache_path}.tmp{os.getpid()}"
+        dataset.save_to_disk(tmp_path)
+        os.replace(tmp_path, cache_path)
+        dataset = load_from_disk(cache_path)
+    return dataset
 
-def process_output_exp1_with_context(example):
-    student_code = f"<code>{example['OUTPUT'].strip()}</code>"
-    return {"output": student_code}
 
 ########################################################
-# EXPERIMENT 2
+# PACKING
 ########################################################
 
-##################
-# without context
-##################
-
-def process_curr_problem_prior_submissions_exp2_without_context(example):
-    curr_problem_prior_submissions = example["curr_problem_prior_submissions"]
-    processed_curr_submissions = ""
-    for submission in curr_problem_prior_submissions:
-        processed_curr_submissions += f"<code>{submission.strip()}</code>"
-    return processed_curr_submissions
-
-def process_input_exp2_without_context(example):
-    input = example["INPUT"]
-    processed_input = EXP_2_WITHOUT_CONTEXT_INPUT_TEMPLATE.format(
-        instructions=process_instructions(input["instructions"]),
-        fixed_code=input["skeleton_code_fixed"].strip(),
-        skeleton_code=input["skeleton_code_todo"].strip(),
-        curr_problem_prior_submissions=process_curr_problem_prior_submissions_exp2_without_context(input)
-    )
-    return {"input": processed_input}
-
-def process_output_exp2_without_context(example):
-    student_code = f"<code>{example['OUTPUT'].strip()}</code>"
-    return {"output": student_code}
-
-
-##################
-# with context
-##################
-
-def process_past_problem_submissions_exp1_with_context(example):
-    past_problem_submissions = example["past_problem_submissions"]
-    processed_past_submissions = ""
-    for submission in past_problem_submissions:
-        processed_past_submissions += (f"PROBLEM NAME: {submission['question_name']}\n")
-        for submission_t in submission["submissions"]:
-            processed_past_submissions += f"<code>{submission_t.strip()}</code>"
-        processed_past_submissions += "\n\n"
-    return processed_past_submissions.strip()
-
-def process_curr_problem_prior_submissions_exp1_with_context(example):
-    curr_problem_prior_submissions = example["curr_problem_prior_submissions"]
-    processed_curr_submissions = ""
-    for submission_t in curr_problem_prior_submissions:
-        processed_curr_submissions += f"<code>{submission_t.strip()}</code>"
-    return processed_curr_submissions
-
-def process_input_exp1_with_context(example):
-    input = example["INPUT"]
-    processed_input = EXP_2_WITH_CONTEXT_INPUT_TEMPLATE.format(
-        past_problem_submissions=process_past_problem_submissions_exp1_with_context(input),
-        instructions=process_instructions(input["instructions"]),
-        fixed_code=input["skeleton_code_fixed"].strip(),
-        skeleton_code=input["skeleton_code_todo"].strip(),
-        curr_problem_prior_submissions=process_curr_problem_prior_submissions_exp1_with_context(input)
+def get_lengths(dataset):
+    # list lengths straight from Arrow, without loading the token ids into Python
+    return pc.list_value_length(dataset.with_format("arrow")["input_ids"]).to_pylist()
+
+def pack_into_bins(lengths, max_seq_length):
+    """
+    Best-fit decreasing: group example indices into bins holding at most
+    `max_seq_length` tokens, longest examples first, each into the fullest
+    bin it still fits in.
+    """
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx], reverse=True)
+    bins = []
+    capacities = []  # sorted (remaining tokens, bin index)
+    for idx in order:
+        length = lengths[idx]
+        pos = bisect.bisect_left(capacities, (length, -1))
+        if pos < len(capacities):
+            remaining, bin_idx = capacities.pop(pos)
+            bins[bin_idx].append(idx)
+            bisect.insort(capacities, (remaining - length, bin_idx))
+        else:
+            bins.append([idx])
+            bisect.insort(capacities, (max_seq_length - length, len(bins) - 1))
+    return bins
+
+def gather_bins(batch, dataset):
+    input_ids, labels, position_ids = [], [], []
+    for indices in batch["example_indices"]:
+        rows = dataset[indices]
+        input_ids.append([token for ids in rows["input_ids"] for token in ids])
+        labels.append([label for row_labels in rows["labels"] for label in row_labels])
+        position_ids.append([position for ids in rows["input_ids"] for position in range(len(ids))])
+    return {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+
+def pack_dataset(dataset, max_seq_length, num_proc=None):
+    """
+    Concatenate tokenized examples into rows of at most `max_seq_length`
+    tokens. Examples are never split; `position_ids` restart at 0 at each
+    example, which marks the boundaries for PackedDataCollator. Labels keep
+    their per-example -100 masking, and since every example starts with
+    prompt tokens no label crosses a boundary.
+    """
+    bins = pack_into_bins(get_lengths(dataset), max_seq_length)
+    return Dataset.from_dict({"example_indices": bins}).map(
+        gather_bins,
+        fn_kwargs={"dataset": dataset},
+        batched=True,
+        remove_columns=["example_indices"],
+        num_proc=num_proc,
     )
-    return {"input": processed_input}
 
-def process_output_exp1_with_context(example):
-    student_code = f"<code>{example['OUTPUT'].strip()}</code>"
-    return {"output": student_code}
+class PackedDataCollator:
+    """
+    Pads packed rows into a batch. With flash attention the restarting
+    `position_ids` are enough for each example to attend only to itself;
+    for sdpa / eager attention a 4D block-diagonal causal mask is built
+    (boolean for sdpa, additive in `dtype` for eager). Padding forms one
+    extra block so no query row is fully masked.
+    """
+
+    def __init__(self, pad_token_id, attn_implementation="sdpa", dtype=torch.float32, pad_to_multiple_of=8):
+        self.pad_token_id = pad_token_id
+        self.attn_implementation = attn_implementation
+        self.dtype = dtype
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features):
+        max_length = max(len(feature["input_ids"]) for feature in features)
+        max_length = -(-max_length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        input_ids = torch.full((len(features), max_length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(features), max_length), -100, dtype=torch.long)
+        position_ids = torch.zeros((len(features), max_length), dtype=torch.long)
+        segment_ids = torch.full((len(features), max_length), -1, dtype=torch.long)
+        for i, feature in enumerate(features):
+            length = len(feature["input_ids"])
+            input_ids[i, :length] = torch.tensor(feature["input_ids"])
+            labels[i, :length] = torch.tensor(feature["labels"])
+            position_ids[i, :length] = torch.tensor(feature["position_ids"])
+            segment_ids[i, :length] = (position_ids[i, :length] == 0).cumsum(-1)
+        batch = {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+        if self.attn_implementation != "flash_attention_2":
+            causal = torch.ones((max_length, max_length), dtype=torch.bool).tril()
+            mask = (segment_ids[:, :, None] == segment_ids[:, None, :]) & causal
+            if self.attn_implementation == "eager":
+                mask = torch.zeros(mask.shape, dtype=self.dtype).masked_fill(~mask, torch.finfo(self.dtype).min)
+            batch["attention_mask"] = mask[:, None, :, :]
+        return batch
+
+
+########################################################
+# TOKEN-BUDGET BATCHING
+########################################################
+
+def split_into_micro_batches(inputs, max_tokens_per_batch, pad_to_multiple_of=8):
+    """
+    Split a right-padded batch into micro-batches of similar length whose
+    padded size (rows * longest row) stays under `max_tokens_per_batch`;
+    each micro-batch is trimmed to its own longest row.
+    """
+    lengths = inputs["attention_mask"].sum(-1)
+    padded_lengths = (-(-lengths // pad_to_multiple_of) * pad_to_multiple_of).tolist()
+    micro_batches, rows = [], []
+    for row in lengths.argsort(descending=True).tolist():
+        # rows come longest first, so the first row of a micro-batch sets its width
+        if rows and (len(rows) + 1) * padded_lengths[rows[0]] > max_tokens_per_batch:
+            micro_batches.append(rows)
+            rows = []
+        rows.append(row)
+    micro_batches.append(rows)
+    return [
+        {key: value[rows, :padded_lengths[rows[0]]] for key, value in inputs.items()}
+        for rows in micro_batches
+    ]
+
+class TokenBudgetTrainer(Trainer):
+    """
+    Trainer for token-budget batching. Each train batch is one optimizer step
+    (`per_device_train_batch_size` examples with `gradient_accumulation_steps=1`)
+    drawn from a length-grouped sampler, and is split into micro-batches of at
+    most `max_tokens_per_batch` padded tokens that are accumulated before the
+    step. Short steps run as one micro-batch, long ones as several, while the
+    examples per step, the loss normalization (label tokens of the whole step)
+    and the learning-rate schedule stay the same.
+    """
+
+    def __init__(self, *args, max_tokens_per_batch, **kwargs):
+        super().__init__(*args, **kwargs)
+        if getattr(self.processing_class, "padding_side", "right") != "right":
+            raise ValueError("TokenBudgetTrainer needs a right-padding tokenizer (tokenizer.padding_side = \"right\")")
+        self.max_tokens_per_batch = max_tokens_per_batch
+
+    def _get_train_sampler(self, train_dataset=None):
+        if train_dataset is None:
+            train_dataset = self.train_dataset
+        return LengthGroupedSampler(self.args.train_batch_size, lengths=get_lengths(train_dataset))
+
+    def training_step(self, model, inputs, num_items_in_batch=None):
+        if num_items_in_batch is None:
+            num_items_in_batch = inputs["labels"].ne(-100).sum()
+        micro_batches = split_into_micro_batches(inputs, self.max_tokens_per_batch)
+        loss = 0.0
+        for i, micro_batch in enumerate(micro_batches):
+            # only the last backward of the step needs to all-reduce gradients
+            if i == len(micro_batches) - 1:
+                loss = loss + super().training_step(model, micro_batch, num_items_in_batch)
+            else:
+                with self.accelerator.no_sync(model):
+                    loss = loss + super().training_step(model, micro_batch, num_items_in_batch)
+        return loss
+
+
+########################################################
+# THROUGHPUT
+########################################################
+
+def peak_memory_mb():
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2**20
+    # peak resident set size of the process (reported in KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+class ThroughputCallback(TrainerCallback):
+    """
+    Time each optimizer step and report step time, input tokens/s (counted by
+    `include_num_input_tokens_seen`, padding included) and peak memory at the
+    end of training; the report is also saved to `<output_dir>/throughput.json`.
+    The first step is treated as warm-up and excluded.
+    """
+
+    def __init__(self):
+        self.step_times = []
+        self.step_start = None
+        self.warmup_tokens = 0
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.step_start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.step_times.append(time.perf_counter() - self.step_start)
+        if len(self.step_times) == 1:
+            self.warmup_tokens = state.num_input_tokens_seen
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero or not self.step_times:
+            return
+        step_times = self.step_times[1:] or self.step_times
+        tokens = state.num_input_tokens_seen - (self.warmup_tokens if len(self.step_times) > 1 else 0)
+        report = {
+            "steps": len(self.step_times),
+            "step_time_mean": statistics.mean(step_times),
+            "step_time_median": statistics.median(step_times),
+            "tokens_per_second": tokens / sum(step_times),
+            "peak_memory_mb": peak_memory_mb(),
+        }
+        print("Throughput:")
+        print(f"  steps: {report['steps']}")
+        print(f"  step time: {report['step_time_mean']:.3f}s mean, {report['step_time_median']:.3f}s median")
+        print(f"  tokens/s: {report['tokens_per_second']:.1f}")
+        print(f"  peak memory: {report['peak_memory_mb']:.1f} MB")
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir, "throughput.json"), "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,3 @@
+# prompt rendering shared by fine-tuning and generation, so both build byte-identical prompts
+from .templates import *
+from .rendering import *
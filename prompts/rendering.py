@@ -0,0 +1,366 @@
+import os
+import re
+import string
+import hashlib
+
+from datasets import load_dataset, load_from_disk
+
+from .templates import *
+
+__all__ = [
+    "CompiledTemplate",
+    "TEMPLATES",
+    "get_template",
+    "process_instructions",
+    "process_stage",
+    "get_stage",
+    "process_problem",
+    "process_output",
+    "join_past_problem_submissions",
+    "process_input_exp1_without_context",
+    "process_output_exp1_without_context",
+    "past_problem_submission_entries_exp1_with_context",
+    "process_past_problem_submissions_exp1_with_context",
+    "process_input_exp1_with_context",
+    "process_output_exp1_with_context",
+    "process_curr_problem_prior_submissions_exp2_without_context",
+    "process_input_exp2_without_context",
+    "process_output_exp2_without_context",
+    "past_problem_submission_entries_exp2_with_context",
+    "process_past_problem_submissions_exp2_with_context",
+    "process_curr_problem_prior_submissions_exp2_with_context",
+    "process_input_exp2_with_context",
+    "process_output_exp2_with_context",
+    "PROCESS_INPUT_FUNCTIONS",
+    "PAST_PROBLEM_SUBMISSION_ENTRY_FUNCTIONS",
+    "ContextPacker",
+    "process_batch",
+    "hash_file",
+    "load_prompt_dataset",
+]
+
+class CompiledTemplate:
+    """
+    A `str.format` template parsed once into its literal text and fields;
+    `render(**fields)` fills the fields and joins the parts, which is several
+    times faster than re-parsing the template with `str.format` on every row.
+    """
+
+    def __init__(self, template):
+        self.parts = []
+        self.field_slots = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            if format_spec or conversion:
+                raise ValueError(f"Template fields with format specs or conversions are not supported: {field}")
+            self.parts.append(literal)
+            if field is not None:
+                self.field_slots.append((len(self.parts), field))
+                self.parts.append("")
+
+    def render(self, **fields):
+        parts = self.parts.copy()
+        for slot, field in self.field_slots:
+            parts[slot] = fields[field]
+        return "".join(parts)
+
+# (experiment, prompt_template) -> compiled input template
+TEMPLATES = {
+    ("exp1_without_context", "ft"): CompiledTemplate(EXP_1_WITHOUT_CONTEXT_INPUT_TEMPLATE_FT),
+    ("exp1_with_context", "ft"): CompiledTemplate(EXP_1_WITH_CONTEXT_INPUT_TEMPLATE_FT),
+    ("exp2_without_context", "ft"): CompiledTemplate(EXP_2_WITHOUT_CONTEXT_INPUT_TEMPLATE_FT),
+    ("exp2_with_context", "ft"): CompiledTemplate(EXP_2_WITH_CONTEXT_INPUT_TEMPLATE_FT),
+    ("exp1_without_context", "prompting"): CompiledTemplate(EXP_1_WITHOUT_CONTEXT_INPUT_TEMPLATE_PROMPTING),
+    ("exp1_with_context", "prompting"): CompiledTemplate(EXP_1_WITH_CONTEXT_INPUT_TEMPLATE_PROMPTING),
+    ("exp2_without_context", "prompting"): CompiledTemplate(EXP_2_WITHOUT_CONTEXT_INPUT_TEMPLATE_PROMPTING),
+    ("exp2_with_context", "prompting"): CompiledTemplate(EXP_2_WITH_CONTEXT_INPUT_TEMPLATE_PROMPTING),
+}
+
+def get_template(experiment_name, prompt_template="ft"):
+    # any prompt template other than "ft" selects the prompting templates
+    return TEMPLATES[(experiment_name, "ft" if prompt_template == "ft" else "prompting")]
+
+def process_instructions(instructions):
+    instructions = re.sub(r"\n+", "\n", instructions)
+    return instructions.strip()
+
+def process_stage(stage, prompt_template="ft"):
+    if prompt_template == "ft":
+        return " ".join(stage.split("_")).upper()
+    else:
+        mapping = {
+            "submission_q0": "first",
+            "submission_q1": "mid-point",
+            "submission_q2": "final",    
+        }
+        return mapping[stage]
+
+def get_stage(example):
+    # the fine-tuning data names the stage field "quantile"
+    stage = example.get("stage")
+    return stage if stage is not None else example["quantile"]
+
+# normalized instructions and skeletons per (semester, assignment, question), with the raw
+# fields they were built from: a row whose fields differ is normalized on its own
+_problem_cache = {}
+
+def process_problem(example):
+    key = (example["semester"], example["assignment_name"], example["question_name"])
+    raw = (example["instructions"], example["skeleton_code_fixed"], example["skeleton_code_todo"])
+    cached = _problem_cache.get(key)
+    if cached is not None and cached[0] == raw:
+        return cached[1]
+    problem = {
+        "instructions": process_instructions(raw[0]),
+        "fixed_code": raw[1].strip(),
+        "skeleton_code": raw[2].strip(),
+    }
+    _problem_cache[key] = (raw, problem)
+    return problem
+
+def process_output(example):
+    student_code = f"<code>{example['OUTPUT'].strip()}</code>"
+    return {"output": student_code}
+
+def join_past_problem_submissions(entries):
+    return "\n\n".join(entries).strip()
+
+
+########################################################
+# EXPERIMENT 1
+########################################################
+
+##################
+# without context
+##################
+
+def process_input_exp1_without_context(example, prompt_template="ft"):
+    input = example["INPUT"]
+    template = get_template("exp1_without_context", prompt_template)
+    processed_input = template.render(
+        **process_problem(input),
+        timestamp=process_stage(get_stage(input), prompt_template)
+    )
+    return {"input": processed_input}
+
+process_output_exp1_without_context = process_output
+
+
+##################
+# with context
+##################
+
+def past_problem_submission_entries_exp1_with_context(example):
+    return [
+        f"PROBLEM NAME: {submission['question_name']}\n<code>{submission['submission'].strip()}</code>"
+        for submission in example["past_problem_submissions"]
+    ]
+
+def process_past_problem_submissions_exp1_with_context(example):
+    return join_past_problem_submissions(past_problem_submission_entries_exp1_with_context(example))
+
+def process_input_exp1_with_context(example, prompt_template="ft", past_problem_submissions=None):
+    input = example["INPUT"]
+    template = get_template("exp1_with_context", prompt_template)
+    if past_problem_submissions is None:
+        past_problem_submissions = process_past_problem_submissions_exp1_with_context(input)
+    processed_input = template.render(
+        past_problem_submissions=past_problem_submissions,
+        **process_problem(input),
+        timestamp=process_stage(get_stage(input), prompt_template)
+    )
+    return {"input": processed_input}
+
+process_output_exp1_with_context = process_output
+
+
+########################################################
+# EXPERIMENT 2
+########################################################
+
+##################
+# without context
+##################
+
+def process_curr_problem_prior_submissions_exp2_without_context(example):
+    return "".join(f"<code>{submission.strip()}</code>" for submission in example["curr_problem_prior_submissions"])
+
+def process_input_exp2_without_context(example, prompt_template="ft"):
+    input = example["INPUT"]
+    template = get_template("exp2_without_context", prompt_template)
+    processed_input = template.render(
+        **process_problem(input),
+        curr_problem_prior_submissions=process_curr_problem_prior_submissions_exp2_without_context(input)
+    )
+    return {"input": processed_input}
+
+process_output_exp2_without_context = process_output
+
+
+##################
+# with context
+##################
+
+def past_problem_submission_entries_exp2_with_context(example):
+    return [
+        f"PROBLEM NAME: {submission['question_name']}\n"
+        + "".join(f"<code>{submission_t.strip()}</code>" for submission_t in submission["submissions"])
+        for submission in example["past_problem_submissions"]
+    ]
+
+def process_past_problem_submissions_exp2_with_context(example):
+    return join_past_problem_submissions(past_problem_submission_entries_exp2_with_context(example))
+
+process_curr_problem_prior_submissions_exp2_with_context = process_curr_problem_prior_submissions_exp2_without_context
+
+def process_input_exp2_with_context(example, prompt_template="ft", past_problem_submissions=None):
+    input = example["INPUT"]
+    template = get_template("exp2_with_context", prompt_template)
+    if past_problem_submissions is None:
+        past_problem_submissions = process_past_problem_submissions_exp2_with_context(input)
+    processed_input = template.render(
+        past_problem_submissions=past_problem_submissions,
+        **process_problem(input),
+        curr_problem_prior_submissions=process_curr_problem_prior_submissions_exp2_with_context(input)
+    )
+    return {"input": processed_input}
+
+process_output_exp2_with_context = process_output
+
+
+########################################################
+# DATASET
+########################################################
+
+PROCESS_INPUT_FUNCTIONS = {
+    "exp1_without_context": process_input_exp1_without_context,
+    "exp1_with_context": process_input_exp1_with_context,
+    "exp2_without_context": process_input_exp2_without_context,
+    "exp2_with_context": process_input_exp2_with_context,
+}
+
+# experiments whose prompts hold past problem submissions, which the ContextPacker can trim
+PAST_PROBLEM_SUBMISSION_ENTRY_FUNCTIONS = {
+    "exp1_with_context": past_problem_submission_entries_exp1_with_context,
+    "exp2_with_context": past_problem_submission_entries_exp2_with_context,
+}
+
+class ContextPacker:
+    """
+    Fits with-context prompts into a token budget. The required sections
+    (template, instructions, skeletons, current-problem submissions) are
+    always kept; the rest of the budget is filled with the most recent past
+    problem submissions (the end of the list), dropping older ones, so prompts
+    are never cut by truncation. Token counts of past submission entries are
+    measured once and reused across the rows that share them.
+    """
+
+    def __init__(self, tokenizer, budget):
+        self.tokenizer = tokenizer
+        self.budget = budget
+        self.entry_lengths = {}
+        self.separator_length = self._count_tokens(["\n\n"])[0]
+
+    def _count_tokens(self, texts):
+        return [len(input_ids) for input_ids in self.tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+    def _prompt_lengths(self, prompts):
+        # as the generation backends count them
+        return [len(input_ids) for input_ids in self.tokenizer(prompts)["input_ids"]]
+
+    def pack(self, renders, entries_list):
+        """
+        `renders[i](past_problem_submissions)` formats row i's prompt and
+        `entries_list[i]` lists its past submission entries (oldest first).
+        Returns the packed prompts.
+        """
+        required_lengths = self._prompt_lengths([render("") for render in renders])
+        new_entries = list({entry for entries in entries_list for entry in entries if entry not in self.entry_lengths})
+        if new_entries:
+            self.entry_lengths.update(zip(new_entries, self._count_tokens(new_entries)))
+
+        # most recent entries whose estimated cost fits next to the required sections
+        num_kept = []
+        for required_length, entries in zip(required_lengths, entries_list):
+            available = self.budget - required_length
+            kept = 0
+            for entry in reversed(entries):
+                available -= self.entry_lengths[entry] + (self.separator_length if kept else 0)
+                if available < 0:
+                    break
+                kept += 1
+            num_kept.append(kept)
+
+        # token counts are not exactly additive: check and drop one more entry where needed
+        prompts = [None] * len(renders)
+        pending = list(range(len(renders)))
+        while pending:
+            candidates = [renders[i](join_past_problem_submissions(entries_list[i][len(entries_list[i]) - num_kept[i]:])) for i in pending]
+            still_pending = []
+            for i, prompt, length in zip(pending, candidates, self._prompt_lengths(candidates)):
+                if length <= self.budget or num_kept[i] == 0:
+                    prompts[i] = prompt
+                else:
+                    num_kept[i] -= 1
+                    still_pending.append(i)
+            pending = still_pending
+        return prompts
+
+def process_batch(batch, experiment_name, prompt_template="ft", packer=None):
+    """Build the prompts and targets of a batch of rows (`dataset.map(batched=True)`)."""
+    process_input = PROCESS_INPUT_FUNCTIONS[experiment_name]
+    get_entries = PAST_PROBLEM_SUBMISSION_ENTRY_FUNCTIONS.get(experiment_name)
+    if packer is not None and get_entries is not None:
+        inputs = packer.pack(
+            [lambda past, input=input: process_input({"INPUT": input}, prompt_template, past)["input"] for input in batch["INPUT"]],
+            [get_entries(input) for input in batch["INPUT"]],
+        )
+    else:
+        inputs = [process_input({"INPUT": input}, prompt_template)["input"] for input in batch["INPUT"]]
+    return {
+        "input": inputs,
+        "output": [process_output({"OUTPUT": output})["output"] for output in batch["OUTPUT"]],
+    }
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def load_prompt_dataset(input_data_path, experiment_name, prompt_template="ft", cache_dir=None, num_proc=None, packer=None):
+    """
+    Load the prompt dataset (`input` / `output` columns) for an experiment,
+    fitting with-context prompts into `packer`'s token budget if given. If
+    `cache_dir` is set, the built dataset is saved there under a key made of
+    the input file hash, experiment name, prompt template, TEMPLATE_VERSION
+    (and the packer's tokenizer and budget), and reused by later runs with the
+    same key.
+    """
+    if experiment_name not in PROCESS_INPUT_FUNCTIONS:
+        raise ValueError(f"Experiment name {experiment_name} not supported")
+    cache_path = None
+    if cache_dir is not None:
+        key = "\n".join([hash_file(input_data_path), experiment_name, prompt_template, str(TEMPLATE_VERSION)])
+        if packer is not None and experiment_name in PAST_PROBLEM_SUBMISSION_ENTRY_FUNCTIONS:
+            key += f"\n{packer.tokenizer.name_or_path}\n{packer.budget}"
+        cache_path = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest()[:16])
+        if os.path.exists(cache_path):
+            return load_from_disk(cache_path)
+
+    dataset = load_dataset("json", data_files=[input_data_path], split="train")
+    dataset = dataset.map(
+        process_batch,
+        fn_kwargs={"experiment_name": experiment_name, "prompt_template": prompt_template, "packer": packer},
+        batched=True,
+        remove_columns=["INPUT", "OUTPUT"],
+        num_proc=num_proc,
+        load_from_cache_file=False,
+    )
+    if cache_path is not None:
+        # save under a temporary name so an interrupted save is never loaded
+        tmp_path = f"{cache_path}.tmp{os.getpid()}"
+        dataset.save_to_disk(tmp_path)
+        os.replace(tmp_path, cache_path)
+        dataset = load_from_disk(cache_path)
+    return dataset
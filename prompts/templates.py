@@ -1,3 +1,6 @@
+# bump when the templates or the prompt assembly in rendering.py change (invalidates cached prompt datasets)
+TEMPLATE_VERSION = 2
+
 ########################################################
 # TEMPLATES FOR FINE-TUNED MODELS
 ########################################################